@@ -1,5 +1,14 @@
+from medmnistc.corruptions.base import get_rng, image_rngs, to_grayscale
+from medmnistc.corruptions.tensor import torch
+from medmnistc.utils import profiling
+
 import numpy as np
 
+try:
+    from torch.utils.data import default_collate
+except ImportError: # only required by `collate`
+    default_collate = None
+
 
 class AugMedMNISTC(object):
     def __init__(self, 
@@ -21,8 +30,14 @@ class AugMedMNISTC(object):
         self.train_corruptions_keys = list(self.train_corruptions.keys()) + ['identity']
 
 
-    def __call__(self, img):
-        corr = np.random.choice(self.train_corruptions_keys)
+    def __call__(self, img, rng=None):
+        """
+        :param img: uint8 array of shape (H, W, 3) or PIL image. Corrupted images are returned as uint8 arrays.
+        :param rng: `np.random.Generator` of the choice of the corruption and of its random draws.
+                    If None, one is keyed from the global numpy random state.
+        """
+        rng = get_rng(rng)
+        corr = self.train_corruptions_keys[rng.integers(len(self.train_corruptions_keys))]
 
         if self.verbose:
             print(corr)
@@ -30,6 +45,90 @@ class AugMedMNISTC(object):
         if corr == 'identity':
             return img
         
-        return self.train_corruptions[corr].apply(img, augmentation=True)
+        return profiling.call(f'AugMedMNISTC.__call__[{corr}]', self.train_corruptions[corr].apply, 
+                              img, augmentation=True, rng=rng)
+
+
+    def sample_corruptions(self, num_images, rng=None):
+        """
+        Corruption of each image of a batch, drawn as in `__call__` with the generator of each image.
 
+        :param num_images: Number of images of the batch.
+        :param rng: Generators of the images (see `image_rngs`).
+        :return: List of the names of the corruptions (including `identity`).
+        """
+        return [self.train_corruptions_keys[img_rng.integers(len(self.train_corruptions_keys))]
+                for img_rng in image_rngs(rng, num_images)]
+
+
+    def apply_batch(self, imgs, rng=None):
+        """
+        Batch-level augmentation: a corruption and an intensity are sampled for each image, the images 
+        are grouped by corruption and each group is corrupted with a single batched call, whose outputs 
+        are scattered back in place. Image `i` is augmented exactly as `self(imgs[i], rng=rngs[i])`, 
+        with `rngs = image_rngs(rng, len(imgs))`, so the sampling distribution is the one of `__call__`
+        (with tensors, the noises are drawn by torch, see `NoiseCorruption`).
+
+        :param imgs: uint8 array of shape (N, H, W, 3) or (N, H, W) for greyscale images, 
+                     or uint8 tensor [B, C, H, W] (see `BaseCorruption.apply_tensor`).
+        :param rng: Generator of each image, or a single generator / None from which a key is drawn
+                    (see `image_rngs`).
+        :return: Augmented images, with the type, shape and channels of `imgs`.
+        """
+        rngs = image_rngs(rng, len(imgs))
+        corrs = self.sample_corruptions(len(imgs), rngs)
+        is_tensor = torch is not None and isinstance(imgs, torch.Tensor)
+        if not is_tensor:
+            imgs = np.asarray(imgs, dtype=np.uint8)
 
+        groups = {}
+        for idx, corr in enumerate(corrs):
+            groups.setdefault(corr, []).append(idx)
+
+        if self.verbose:
+            print({corr: len(idx) for corr, idx in groups.items()})
+
+        out = imgs.clone() if is_tensor else imgs.copy()
+        for corr, idx in groups.items():
+            if corr == 'identity':
+                continue
+            group_rngs = [rngs[i] for i in idx]
+            if is_tensor:
+                idx = torch.tensor(idx, dtype=torch.int64)
+            out[idx] = profiling.call(f'AugMedMNISTC.apply_batch[{corr}]', self.augment_group, 
+                                      imgs[idx], corr, group_rngs, num_images=len(group_rngs))
+        return out
+
+
+    def augment_group(self, imgs, corr, rng):
+        """
+        Corrupt a batch of images with the corruption `corr`, in augmentation mode (see `apply_batch`).
+        Greyscale arrays (N, H, W) are corrupted in RGB and converted back.
+        """
+        corruption = self.train_corruptions[corr]
+        if not isinstance(imgs, np.ndarray):
+            return corruption.apply_tensor(imgs, augmentation=True, rng=rng)
+        if imgs.ndim == 3:
+            return to_grayscale(corruption.apply_batch(np.repeat(imgs[..., None], 3, axis=-1), augmentation=True, rng=rng))
+        return corruption.apply_batch(imgs, augmentation=True, rng=rng)
+
+
+    def collate(self, batch, transform=None, rng=None):
+        """
+        `collate_fn` of a DataLoader augmenting whole batches (see `apply_batch`): the images of the 
+        (image, target) samples are stacked, augmented (one `augment_group` call per corruption), optionally 
+        transformed one by one (e.g. `transforms.ToTensor()` and `transforms.Normalize`), and collated with 
+        torch's `default_collate`. Use `functools.partial(augment.collate, transform=...)` to set the transform.
+
+        :param batch: List of (image, target) samples, with uint8 arrays or PIL images of the same size,
+                      all RGB or all greyscale.
+        :param transform: Transform applied to each augmented image (uint8 array) before collating.
+        :param rng: Generators of the images (see `image_rngs`).
+        """
+        if default_collate is None:
+            raise ImportError("`AugMedMNISTC.collate` requires PyTorch.")
+        imgs = np.stack([np.asarray(img, dtype=np.uint8) for img, _ in batch])
+        imgs = self.apply_batch(imgs, rng)
+        if transform is not None:
+            imgs = [transform(img) for img in imgs]
+        return default_collate([(img, target) for img, (_, target) in zip(imgs, batch)])
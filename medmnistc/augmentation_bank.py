@@ -0,0 +1,256 @@
+from medmnistc.augmentation import AugMedMNISTC
+from medmnistc.corruptions.base import image_rng, get_rng
+from medmnistc.utils.utils import derive_seed
+from medmnistc.utils.storage import save_npy_chunks, save_json, array_checksum, file_checksum
+from medmnistc.utils.parallel import WORKER_STATE, worker_pool, imap_bounded
+from medmnistc.utils import profiling
+from torch.utils.data import Dataset
+import numpy as np
+import json
+import os
+
+from tqdm import tqdm
+
+
+# Scheme of the random streams of the variants, recorded in the manifest of the bank.
+_SEEDING = 'per-variant-philox'
+
+
+def variant_rng(random_seed, corruption, variant, index):
+    """
+    Generator of the stored variant keyed by (seed, corruption, variant, index). As in `sample_rng`,
+    each variant can be regenerated in isolation, and adding variants leaves the existing ones unchanged, e.g.
+    `train_corruptions[corruption].apply(img, augmentation=True, rng=variant_rng(...))`.
+
+    :param random_seed: Base seed of the bank.
+    :param corruption: Name of the corruption.
+    :param variant: Index of the variant, in [0, num_variants).
+    :param index: Index of the image in the training set.
+    """
+    return image_rng(derive_seed(random_seed, 'bank', corruption, variant), index)
+
+
+def _augment_unit(unit):
+    """
+    Augment one work unit, i.e. the variant `variant` of the images [start,stop) with a given corruption.
+
+    :param unit: Tuple (corruption, variant, start, stop).
+    """
+    corruption, variant, start, stop = unit
+    rngs = [variant_rng(WORKER_STATE['random_seed'], corruption, variant, index) for index in range(start, stop)]
+
+    imgs = np.asarray(WORKER_STATE['imgs'][start:stop])
+
+    # The defined corruptions support RGB images
+    if imgs.ndim == 3:
+        imgs = np.repeat(imgs[..., None], 3, axis=-1)
+
+    return WORKER_STATE['train_corruptions'][corruption].apply_batch(imgs, augmentation=True, rng=rngs)
+
+
+def _bank_entry(corruptor, imgs_checksum, num_images, num_variants, random_seed):
+    return {'config': corruptor.get_config(),
+            'images_sha256': imgs_checksum,
+            'num_images': num_images,
+            'num_variants': num_variants,
+            'random_seed': random_seed,
+            'seeding': _SEEDING}
+
+
+def _is_up_to_date(bank_path, corruption, recorded, entry):
+    """
+    Check whether a recorded manifest entry matches the current one and its bank is intact (as `DatasetManager`).
+
+    :param bank_path: Folder of the bank.
+    :param corruption: Name of the corruption.
+    :param recorded: Entry stored in the manifest (None if missing).
+    :param entry: Entry of the current run (without checksum).
+    """
+    if recorded is None or {k : v for (k, v) in recorded.items() if k != 'sha256'} != entry:
+        return False
+
+    filepath = os.path.join(bank_path, f'{corruption}.npy')
+    return os.path.exists(filepath) and file_checksum(filepath) == recorded.get('sha256')
+
+
+def _load_manifest(bank_path):
+    manifest_path = os.path.join(bank_path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def create_augmentation_bank(imgs,
+                             train_corruptions: dict,
+                             bank_path: str,
+                             num_variants: int = 4,
+                             corruptions: list = None,
+                             random_seed: int = 0,
+                             num_workers: int = 0,
+                             chunk_size: int = 256,
+                             resume: bool = True):
+    """
+    Pre-generate `num_variants` augmented variants of each training image, for the (expensive) corruptions
+    to bank. Each variant is drawn exactly as `AugMedMNISTC` does online for this corruption
+    (intensity uniformly sampled in [min_intensity, max_intensity]), from its own generator (see `variant_rng`).
+    Path convention: {bank_path} / {corruption}.npy, a raw (memory-mappable) uint8 array of shape
+    (N, num_variants, H, W, 3), so that the variants of one image are contiguous on disk,
+    and {bank_path} / manifest.json, describing the bank.
+
+    :param imgs: Clean training images (N, H, W[, 3]), e.g. `dataset.imgs` of a MedMNIST training split,
+                 or path to a raw `.npy` file, which is memory-mapped.
+    :param train_corruptions: Dictionary containing the corruptions to use during training (e.g. `CORRUPTIONS_DS[dataset]`).
+    :param bank_path: Output folder of the bank.
+    :param num_variants: Number of variants stored per image and corruption.
+    :param corruptions: Names of the corruptions to bank. If None, all the `train_corruptions`.
+    :param random_seed: Base seed of the variants. The outputs do not depend on `num_workers` nor on `chunk_size`.
+    :param num_workers: Number of worker processes. If 0, everything runs in the main process.
+    :param chunk_size: Number of images of each work unit (corruption, variant, chunk).
+    :param resume: If True, skip the corruptions whose bank is up-to-date according to the manifest,
+                   which records the checksums of the clean images and of each bank.
+    """
+    assert num_variants > 0, f"`num_variants` must be positive, got {num_variants}"
+    assert num_workers >= 0, f"`num_workers` must be non-negative, got {num_workers}"
+    assert chunk_size > 0, f"`chunk_size` must be positive, got {chunk_size}"
+
+    corruptions = list(train_corruptions) if corruptions is None else list(corruptions)
+    assert all(corruption in train_corruptions for corruption in corruptions), f"Unknown corruptions. Please choose among : {list(train_corruptions)}"
+
+    os.makedirs(bank_path, exist_ok=True)
+    worker_imgs = imgs
+    if isinstance(imgs, str):
+        imgs = np.load(imgs, mmap_mode='r')
+    num_images = len(imgs)
+    shape = (num_images, num_variants) + tuple(imgs.shape[1:3]) + (3,)
+    imgs_checksum = array_checksum(imgs)
+
+    manifest = _load_manifest(bank_path)
+    entries = {corruption: json.loads(json.dumps(_bank_entry(train_corruptions[corruption], imgs_checksum, num_images, num_variants, random_seed)))
+               for corruption in corruptions}
+    pending = []
+    for corruption in corruptions:
+        if resume and _is_up_to_date(bank_path, corruption, manifest.get(corruption), entries[corruption]):
+            print(f'Skipping {corruption} (up-to-date)')
+        else:
+            pending.append(corruption)
+
+    if len(pending) == 0:
+        return
+
+    worker_state = {'imgs': worker_imgs, 'train_corruptions': train_corruptions, 'random_seed': random_seed}
+
+    with worker_pool(num_workers, worker_state) as pool:
+        for corruption in pending:
+            units = [(corruption, variant, start, min(start + chunk_size, num_images))
+                     for start in range(0, num_images, chunk_size) for variant in range(num_variants)]
+
+            # Units are returned in order, and written into an on-disk array, moved to its final path once complete
+            results = tqdm(imap_bounded(pool, _augment_unit, units, 2 * num_workers), total=len(units), desc=corruption)
+            chunks = (((slice(start, stop), variant), chunk) for (_, variant, start, stop), chunk in zip(units, results))
+            filepath = os.path.join(bank_path, f'{corruption}.npy')
+            save_npy_chunks(filepath, shape, chunks)
+
+            manifest[corruption] = dict(entries[corruption], sha256=file_checksum(filepath))
+            save_json(os.path.join(bank_path, 'manifest.json'), manifest, indent=2)
+
+
+class AugMedMNISTCBank(AugMedMNISTC):
+    def __init__(self,
+                 train_corruptions : dict,
+                 bank_path : str,
+                 verbose: bool = False):
+        """
+        Offline version of `AugMedMNISTC`, reading the banked corruptions (see `create_augmentation_bank`)
+        rather than recomputing them. The corruption is chosen exactly as online (including `identity`):
+        a banked corruption returns one of the stored variants of the image, uniformly at random, while
+        the other corruptions are still computed online. Each variant being an online sample, the
+        distribution of the augmented images is the one of `AugMedMNISTC` (only the intensities are
+        reused across the epochs). The banks are memory-mapped: a sample costs a page read.
+
+        :param train_corruptions: Dictionary containing the corruptions to use during training.
+        :param bank_path: Folder of the bank, generated with the same `train_corruptions`.
+        :param verbose: If True, print the name of the selected corruption.
+        """
+        super().__init__(train_corruptions, verbose)
+
+        self.bank_path = bank_path
+        self.entries = _load_manifest(bank_path)
+        self.banks = {}
+        for corruption, entry in self.entries.items():
+            assert corruption in train_corruptions, f"The bank of {corruption} does not match the `train_corruptions`."
+            assert entry['config'] == train_corruptions[corruption].get_config(), f"The bank of {corruption} is stale: its corruption parameters changed."
+            bank = np.load(os.path.join(bank_path, f'{corruption}.npy'), mmap_mode='r')
+            assert bank.shape[:2] == (entry['num_images'], entry['num_variants']), f"The bank of {corruption} has shape {bank.shape}, which does not match its manifest entry."
+            self.banks[corruption] = bank
+
+
+    def __call__(self, img, index, rng=None):
+        """
+        :param img: uint8 array of shape (H, W, 3) or PIL image. Corrupted images are returned as uint8 arrays.
+        :param index: Index of the image in the training set (i.e. in the images of the bank).
+        :param rng: `np.random.Generator` of the choice of the corruption, of the variant and of the online draws.
+                    If None, one is keyed from the global numpy random state.
+        """
+        rng = get_rng(rng)
+        corr = self.train_corruptions_keys[rng.integers(len(self.train_corruptions_keys))]
+
+        if self.verbose:
+            print(corr)
+
+        if corr == 'identity':
+            return img
+
+        if corr in self.banks:
+            variants = self.banks[corr][index]
+            return profiling.call(f'AugMedMNISTCBank.__call__[{corr}]', np.array, variants[rng.integers(len(variants))])
+
+        return profiling.call(f'AugMedMNISTC.__call__[{corr}]', self.train_corruptions[corr].apply,
+                              img, augmentation=True, rng=rng)
+
+
+class AugmentedDataset(Dataset):
+    def __init__(self,
+                 dataset : Dataset,
+                 augment : AugMedMNISTCBank,
+                 transform = None,
+                 check_images : bool = True):
+        """
+        Training dataset wrapper applying `AugMedMNISTCBank`, which needs the index of each sample.
+
+        :param dataset: Training dataset returning (image, target), without transform (e.g. a MedMNIST
+                        dataset with `transform=None`), in the order of the images of the bank.
+        :param augment: Offline augmentation.
+        :param transform: Transform applied after the augmentation (e.g. `ToTensor` and `Normalize`).
+        :param check_images: If True and `dataset` exposes its images (`dataset.imgs`, as MedMNIST datasets),
+                             check that the banks were generated from the same images, in the same order.
+        """
+        super(AugmentedDataset, self).__init__()
+
+        for corruption, bank in augment.banks.items():
+            assert len(bank) == len(dataset), f"The bank of {corruption} holds {len(bank)} images, while the dataset has {len(dataset)}."
+
+        imgs = getattr(dataset, 'imgs', None) if check_images else None
+        if imgs is not None and len(augment.banks) > 0:
+            imgs_checksum = array_checksum(imgs)
+            for corruption in augment.banks:
+                assert augment.entries[corruption]['images_sha256'] == imgs_checksum, \
+                    f"The bank of {corruption} was generated from other images (or in another order) than the ones of the dataset."
+
+        self.dataset = dataset
+        self.augment = augment
+        self.transform = transform
+
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+    def __getitem__(self, index):
+        img, target = self.dataset[index]
+        img = self.augment(img, index)
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, target
@@ -1,23 +1,259 @@
+from .tensor import check_tensor, tensor_to_array, array_to_tensor
+from medmnistc.utils import profiling
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
 import numpy as np
 import cv2
 import os
 
+
+# Thread pool shared by the batch paths whose kernels release the GIL (OpenCV, PIL resampling).
+# It is (re)created lazily, so that forked processes do not inherit a pool without threads.
+_THREAD_POOL = {'pool': None, 'pid': None, 'num_threads': os.cpu_count() or 1}
+
+
+def set_num_threads(num_threads):
+    """
+    Set the number of threads used by the batch paths of the corruptions (1 disables threading).
+    """
+    assert num_threads >= 1, f"`num_threads` must be positive, got {num_threads}"
+    if _THREAD_POOL['pool'] is not None and _THREAD_POOL['pid'] == os.getpid():
+        _THREAD_POOL['pool'].shutdown()
+    _THREAD_POOL.update(pool=None, pid=None, num_threads=num_threads)
+
+
+def thread_map(func, *iterables):
+    """
+    Equivalent of `list(map(func, *iterables))`, run on the shared thread pool.
+    """
+    if _THREAD_POOL['num_threads'] == 1:
+        return list(map(func, *iterables))
+    if _THREAD_POOL['pool'] is None or _THREAD_POOL['pid'] != os.getpid():
+        _THREAD_POOL.update(pool=ThreadPoolExecutor(_THREAD_POOL['num_threads']), pid=os.getpid())
+    return list(_THREAD_POOL['pool'].map(func, *iterables))
+
+
+def image_rng(key, index):
+    """
+    Counter-based generator (Philox) of the image `index` under `key`. The images use disjoint
+    blocks of the counter space, so the random draws of each image can be reproduced independently 
+    of every other image, in any order and on any worker.
+
+    :param key: Philox key, e.g. derived from the seed, dataset, corruption and severity.
+    :param index: Index of the image.
+    """
+    return np.random.Generator(np.random.Philox(key=key, counter=[0, 0, 0, index]))
+
+
+def image_rngs(rng, num_images):
+    """
+    Generator of each image of a batch.
+
+    :param rng: Sequence of generators (one per image), a generator from which the key is drawn,
+                or None to draw the key from the global (legacy) numpy random state.
+    :param num_images: Number of images of the batch.
+    """
+    if rng is None or isinstance(rng, np.random.Generator):
+        key = int(np.random.randint(2**63, dtype=np.int64)) if rng is None else int(rng.integers(2**63))
+        return [image_rng(key, idx) for idx in range(num_images)]
+    assert len(rng) == num_images, f"Expected {num_images} generators, got {len(rng)}"
+    return list(rng)
+
+
+def get_rng(rng=None):
+    """
+    Generator of a single image: `rng` itself, or if None a generator keyed from the global numpy 
+    random state (so that `seed_everything` keeps the outputs reproducible).
+    """
+    return image_rngs(None, 1)[0] if rng is None else rng
+
+
+def uniform(rng, low, high):
+    """
+    Uniform sample in [low, high) drawn with `rng`. As `np.random.uniform`, it also accepts high < low
+    (e.g. decreasing intensities), which `Generator.uniform` rejects. The samples are reported to the profiler.
+    """
+    value = low + (high - low) * rng.random()
+    if profiling.is_enabled():
+        profiling.record_param(value)
+    return value
+
+
+def quantize(values, low, high, levels):
+    """
+    Round `values` to the closest of `levels` evenly spaced values in [low, high], e.g. so that the 
+    tables or kernels derived from the parameters sampled in augmentation mode can be cached.
+    """
+    if high == low:
+        return np.full(np.shape(values), low, dtype=np.float64)
+    step = (high - low) / (levels - 1)
+    return low + np.round((np.asarray(values) - low) / step) * step
+
+
+# Process-wide cache of the decoded ink sprites (see `load_inks`)
+_INKS = {}
+
+
+def load_inks():
+    """
+    Ink sprites of `StainDeposit`, by size ('1' to '5'), as read-only float32 arrays of shape (N, h, w, 1) 
+    with values in {0, 1}. The archive is decoded once per process, and the cache is shared by all the 
+    corruptions. Once loaded, it is inherited (copy-on-write) by the forked worker processes.
+    """
+    if not _INKS:
+        # Get the directory of the current file (__file__ is the path to the current file)
+        current_file_dir = os.path.dirname(os.path.realpath(__file__))
+        inks_path = os.path.join(current_file_dir, './../', 'assets', 'inks.npz')
+        with np.load(inks_path) as archive:
+            inks = {size: archive[size].astype(np.float32)[..., None] for size in archive.files}
+        for sprites in inks.values():
+            sprites.flags.writeable = False
+        _INKS.update(inks)
+    return _INKS
+
+
 class BaseCorruption:
+    # Libraries, besides NumPy, whose version may affect the outputs (see `get_libraries`)
+    libraries = []
+
     def __init__(self, severity_params):
         self.severity_params = severity_params
         self.font = cv2.FONT_HERSHEY_DUPLEX 
-        self._inks = None
+
+    def __init_subclass__(cls, **kwargs):
+        # Opt-in profiling of the corruptions (see `medmnistc.utils.profiling`)
+        super().__init_subclass__(**kwargs)
+        for name in ['apply', 'apply_batch', 'apply_tensor']:
+            if name in cls.__dict__:
+                setattr(cls, name, profiling.profiled(cls.__dict__[name]))
 
     @property
     def inks(self):
-        if self._inks is None:
-            # Get the directory of the current file (__file__ is the path to the current file)
-            current_file_dir = os.path.dirname(os.path.realpath(__file__))
-            inks_path = os.path.join(current_file_dir, './../', 'assets', 'inks.npz')
-            self._inks = np.load(inks_path, allow_pickle=True)
-        return self._inks
-
-    def apply(self, img):
+        return load_inks()
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        """
+        Apply the corruption to a single image.
+
+        :param img: uint8 RGB array of shape (H, W, 3). Greyscale arrays and PIL images are 
+                    also accepted and converted through `to_rgb_array`.
+        :param severity: Severity index, ignored in augmentation mode.
+        :param augmentation: If True, the intensity is uniformly sampled in [min_intensity, max_intensity].
+        :param rng: `np.random.Generator` of all the random draws. If None, one is keyed 
+                    from the global numpy random state (see `get_rng`).
+        :return: uint8 RGB array of shape (H, W, 3).
+        """
         raise NotImplementedError("This method should be implemented by subclasses.")
 
+    @profiling.profiled
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        """
+        Apply the corruption to a batch of RGB images.
+        This generic fallback calls `apply` on each image, while vectorized
+        corruptions override it to process the whole batch at once.
+        Image `i` is corrupted exactly as `apply(imgs[i], ..., rng=rngs[i])`, 
+        with `rngs = image_rngs(rng, len(imgs))`.
+
+        :param imgs: uint8 array of shape (N, H, W, C).
+        :param severity: Severity index, ignored in augmentation mode.
+        :param augmentation: If True, the intensity is sampled independently for each image.
+        :param rng: Generator of each image, or a single generator / None from which a key is drawn
+                    (see `image_rngs`).
+        :return: uint8 array of shape (N, H, W, C).
+        """
+        rngs = image_rngs(rng, len(imgs))
+        return np.stack([self.apply(img, severity, augmentation, img_rng) for img, img_rng in zip(imgs, rngs)]).astype(np.uint8)
+
+    @profiling.profiled
+    def apply_tensor(self, imgs, severity=-1, augmentation=False, rng=None):
+        """
+        Apply the corruption to a batch of CPU tensors (e.g. in the collate function of a DataLoader),
+        without converting the images to PIL. Greyscale batches are corrupted in RGB and converted back, 
+        as in `DatasetManager`. This generic fallback runs `apply_batch` on a channels-last copy, while 
+        the corruptions with native torch kernels override it (running on torch's intra-op threads).
+
+        :param imgs: uint8 tensor [B, C, H, W], with C = 1 or 3.
+        :param severity: Severity index, ignored in augmentation mode.
+        :param augmentation: If True, the intensity is sampled independently for each image.
+        :param rng: Generator of each image, or a single generator / None from which a key is drawn
+                    (see `image_rngs`).
+        :return: uint8 tensor [B, C, H, W].
+        """
+        check_tensor(imgs)
+        out = self.apply_batch(tensor_to_array(imgs), severity, augmentation, rng)
+        return array_to_tensor(out, imgs.shape[1])
+
+    def sample_param(self, severity=-1, augmentation=False, rng=None):
+        """
+        Scalar intensity of a single image: uniformly sampled in
+        [min_intensity, max_intensity] with `rng` in augmentation mode, otherwise the one of `severity`.
+        """
+        if augmentation:
+            range_min, range_max = self.severity_params[0], self.severity_params[-1]
+            return uniform(get_rng(rng), range_min, range_max)
+        return self.severity_params[severity]
+
+    def sample_batch_params(self, num_images, severity=-1, augmentation=False, rng=None):
+        """
+        Scalar intensity of each image of a batch, drawn as `sample_param` with the generator of each image.
+
+        :param num_images: Number of images of the batch.
+        :param severity: Severity index, ignored in augmentation mode.
+        :param augmentation: Whether to sample the intensities.
+        :param rng: Generators of the images (see `image_rngs`).
+        """
+        if augmentation:
+            range_min, range_max = self.severity_params[0], self.severity_params[-1]
+            return np.array([uniform(img_rng, range_min, range_max) for img_rng in image_rngs(rng, num_images)])
+        return np.full(num_images, self.severity_params[severity], dtype=np.float64)
+
+    def get_config(self):
+        """
+        JSON-serializable description of the corruption (e.g. used to detect stale outputs).
+        """
+        return {'name': type(self).__name__, 'severity_params': to_jsonable(self.severity_params)}
+
+    def get_libraries(self):
+        """
+        Names of the libraries whose version may affect the corrupted images (e.g. recorded in the run manifest 
+        of `DatasetManager`, so that upgrading an unrelated library does not make the outputs stale).
+        """
+        return ['numpy'] + list(self.libraries)
+
+
+def to_jsonable(value):
+    """
+    Recursively convert numpy arrays, numpy scalars and tuples into JSON-serializable objects.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(v) for v in value]
+    return value
+
+
+def to_rgb_array(img):
+    """
+    Compatibility shim of the corruptions: return `img` as a uint8 RGB array of shape (H, W, 3).
+    PIL images are converted once, greyscale arrays are replicated over the channels, 
+    and uint8 RGB arrays are returned as they are (no copy).
+    """
+    if isinstance(img, Image.Image):
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return np.asarray(img)
+    img = np.asarray(img, dtype=np.uint8)
+    if img.ndim == 2:
+        img = np.repeat(img[..., None], 3, axis=-1)
+    return img
+
 
+def to_grayscale(imgs):
+    """
+    Convert RGB images (..., 3) to greyscale, bit-exact with PIL's `convert('L')`.
+    """
+    imgs = imgs.astype(np.uint32)
+    return ((imgs[..., 0] * 19595 + imgs[..., 1] * 38470 + imgs[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
@@ -1,36 +1,129 @@
-from .base import BaseCorruption
+from .base import BaseCorruption, to_rgb_array, thread_map, get_rng, uniform
+from .tensor import torch, PRECISION_BITS, check_tensor, group_by, box_resize_tensor
+from functools import lru_cache
 from PIL import Image
-from io import BytesIO
 
 import numpy as np
+import cv2
+
+
+@lru_cache(maxsize=256)
+def box_upscale_indices(in_size, out_size):
+    """
+    Cached source indices of PIL's `Image.BOX` resampling when upscaling from `in_size` to `out_size`.
+    With a scale factor below 1, each output pixel takes exactly one input pixel (the one whose
+    box contains its center, computed with the same floating point expressions as PIL),
+    so the resize reduces to a gather. The returned array is read-only.
+    """
+    scale = in_size / out_size
+    center = (np.arange(out_size) + 0.5) * scale
+    idx = np.maximum((center - 0.5 + 0.5).astype(np.intp), 0)
+    # the box filter of PIL is 1 on (-0.5, 0.5]
+    offset = idx - center + 0.5
+    idx += ~((offset > -0.5) & (offset <= 0.5))
+    idx = np.minimum(idx, in_size - 1)
+    idx.flags.writeable = False
+    return idx
+
+
+@lru_cache(maxsize=256)
+def box_downscale_weights(in_size, out_size):
+    """
+    Cached coefficients (out_size, in_size) of PIL's `Image.BOX` resampling when downscaling from `in_size` 
+    to `out_size`, in PIL's fixed-point format (scaled by 2**PRECISION_BITS and rounded), as float64.
+    Each output pixel averages the input pixels whose center falls in its box. The returned array is read-only.
+    """
+    scale = in_size / out_size
+    support = 0.5 * max(scale, 1.0)
+    weights = np.zeros((out_size, in_size))
+    for out_idx in range(out_size):
+        center = (out_idx + 0.5) * scale
+        low, high = max(int(center - support + 0.5), 0), min(int(center + support + 0.5), in_size)
+        # the box filter of PIL is 1 on (-0.5, 0.5]
+        offsets = (np.arange(low, high) - center + 0.5) * (1.0 / max(scale, 1.0))
+        box = ((offsets > -0.5) & (offsets <= 0.5)).astype(np.float64)
+        if box.sum() > 0:
+            box /= box.sum()
+        weights[out_idx, low:high] = np.floor(box * (1 << PRECISION_BITS) + 0.5)
+    weights.flags.writeable = False
+    return weights
+
+
+def pixelate(img, resize_factor):
+    """
+    Downscale and upscale back `img` with PIL's `Image.BOX` filter, bit-exact with PIL. 
+    The downscaling runs in PIL (which releases the GIL), the upscaling is an equivalent gather.
+
+    :param img: uint8 array of shape (H, W, C).
+    :param resize_factor: Scale factor of the downscaled image.
+    """
+    height, width = img.shape[:2]
+    small = Image.fromarray(img).resize((int(width * resize_factor), int(height * resize_factor)), Image.BOX)
+    small = np.asarray(small)
+    rows = box_upscale_indices(small.shape[0], height)
+    cols = box_upscale_indices(small.shape[1], width)
+    return np.take(np.take(small, rows, axis=0), cols, axis=1)
+
+
+def jpeg_compression(img, quality):
+    """
+    JPEG encoding and decoding of an RGB image with OpenCV (which releases the GIL).
+    With the same libjpeg settings (4:2:0 chroma subsampling), it matches PIL's `img.save(..., 'JPEG', quality=quality)`.
+
+    :param img: uint8 array of shape (H, W, 3).
+    :param quality: JPEG quality, in [0, 100].
+    """
+    _, buffer = cv2.imencode('.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    return cv2.cvtColor(cv2.imdecode(buffer, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
 
 
 class Pixelate(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
+    libraries = ['PIL']
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        rng = get_rng(rng)
         
         if augmentation:
             range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            resize_factor = np.random.uniform(low=range_min, high=range_max, size=None)
+            resize_factor = uniform(rng, range_min, range_max)
         else:
             resize_factor = self.severity_params[severity]
-        
-        
-        width, height = img.size
-        img = img.resize((int(width * resize_factor), int(height * resize_factor)), Image.BOX)
-        img = img.resize((width, height), Image.BOX)
-        return np.array(img)
+
+        return pixelate(to_rgb_array(img), resize_factor)
+
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        resize_factors = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        return np.stack(thread_map(pixelate, imgs, resize_factors))
+
+    def apply_tensor(self, imgs, severity=-1, augmentation=False, rng=None):
+        # Linear on each channel (up to PIL's rounding): greyscale batches are processed as they are
+        check_tensor(imgs)
+        height, width = imgs.shape[2:]
+        resize_factors = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        sizes = [(int(height * resize_factor), int(width * resize_factor)) for resize_factor in resize_factors]
+        out = torch.empty_like(imgs)
+        for (small_height, small_width), idx in group_by(sizes).items():
+            small = box_resize_tensor(imgs[idx], box_downscale_weights(height, small_height), box_downscale_weights(width, small_width))
+            rows = torch.tensor(box_upscale_indices(small_height, height), dtype=torch.int64)
+            cols = torch.tensor(box_upscale_indices(small_width, width), dtype=torch.int64)
+            out[idx] = small.index_select(2, rows).index_select(3, cols)
+        return out
 
 
 class JPEGCompression(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
+    libraries = ['cv2']
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        rng = get_rng(rng)
         
         if augmentation:
             range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            compression_quality = int(np.random.uniform(low=range_min, high=range_max, size=None))
+            compression_quality = int(uniform(rng, range_min, range_max))
         else:
             compression_quality = self.severity_params[severity]
         
-        output = BytesIO()
-        img.save(output, 'JPEG', quality=compression_quality)
-        img = Image.open(output)
-        return np.array(img)
\ No newline at end of file
+        return jpeg_compression(to_rgb_array(img), compression_quality)
+
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        compression_qualities = self.sample_batch_params(len(imgs), severity, augmentation, rng).astype(int)
+        return np.stack(thread_map(jpeg_compression, imgs, compression_qualities))
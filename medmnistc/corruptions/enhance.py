@@ -1,56 +1,206 @@
-from .base import BaseCorruption
-from PIL import ImageEnhance
+from .base import BaseCorruption, to_rgb_array, get_rng, quantize
+from .tensor import check_tensor, gather_luts, grayscale_tensor
 import skimage as sk
+from functools import lru_cache
+
 import numpy as np
+import cv2
 
-import torchvision.transforms.functional as TF
 
+# Number of levels of the intensity parameters sampled in augmentation mode, 
+# so that their lookup tables can be cached
+LUT_LEVELS = 1024
 
-class Brightness(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
-        if augmentation:
-            range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            brightness_factor  = np.random.uniform(low=range_min, high=range_max, size=None)
-        else:
-            brightness_factor = self.severity_params[severity]
-        enhancer = ImageEnhance.Brightness(img)
-        brightened_img = enhancer.enhance(brightness_factor)
-        return np.array(brightened_img).astype(np.uint8)
 
+@lru_cache(maxsize=4096)
+def blend_lut(degenerate, factor):
+    """
+    Cached lookup table of PIL's `Image.blend(degenerate, img, factor)`, used by `ImageEnhance`,
+    for a uniform degenerate image. As in PIL, it is computed in float32 and truncated to uint8.
+    The returned array is read-only.
 
-class Contrast(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
-        if augmentation:
-            range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            contrast_factor  = np.random.uniform(low=range_min, high=range_max, size=None)
+    :param degenerate: Value of the degenerate image.
+    :param factor: Enhancement factor.
+    """
+    values = np.arange(256, dtype=np.int32) - degenerate
+    lut = np.clip(np.float32(degenerate) + np.float32(factor) * values.astype(np.float32), 0, 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def blend_luts(degenerate, factors):
+    """
+    Lookup tables (N, 256) of `blend_lut` for each image.
+
+    :param degenerate: Value of the degenerate image, scalar or one per image.
+    :param factors: Enhancement factor of each image.
+    """
+    degenerate = np.broadcast_to(np.asarray(degenerate, dtype=np.int64), np.shape(factors))
+    return np.stack([blend_lut(int(value), float(factor)) for value, factor in zip(degenerate, factors)])
+
+
+def apply_luts(imgs, luts):
+    """
+    Apply one lookup table per image. The images sharing the same table
+    (e.g. the whole batch, for a fixed severity) are processed by a single `cv2.LUT` call.
+
+    :param imgs: uint8 array of shape (N, H, W, C).
+    :param luts: uint8 array of shape (N, 256).
+    """
+    unique_luts, inverse = np.unique(luts, axis=0, return_inverse=True)
+    if len(unique_luts) == 1:
+        return cv2.LUT(imgs.reshape(imgs.shape[0] * imgs.shape[1], -1), unique_luts[0]).reshape(imgs.shape)
+
+    out = np.empty_like(imgs)
+    for lut_idx, lut in enumerate(unique_luts):
+        idx = np.flatnonzero(inverse.ravel() == lut_idx)
+        if len(idx) == 1:
+            out[idx[0]] = cv2.LUT(imgs[idx[0]], lut)
         else:
-            contrast_factor = self.severity_params[severity]
-        enhancer = ImageEnhance.Contrast(img)
-        contrasted_img = enhancer.enhance(contrast_factor)
-        return np.array(contrasted_img).astype(np.uint8)
+            group = imgs[idx]
+            out[idx] = cv2.LUT(group.reshape(group.shape[0] * group.shape[1], -1), lut).reshape(group.shape)
+    return out
 
 
-class GammaCorrection(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
+def grayscale_means(imgs):
+    """
+    Mean of each image after PIL's `convert('L')`, as computed by `ImageEnhance.Contrast`.
+    The fixed-point conversion is evaluated with a float32 product, which is exact 
+    since all the intermediate values are integers below 2**24.
+
+    :param imgs: uint8 array of shape (N, H, W, 3).
+    """
+    weights = np.array([19595, 38470, 7471], dtype=np.float32)
+    gray = np.floor((imgs.reshape(-1, 3).astype(np.float32) @ weights + 0x8000) / 65536)
+    return gray.reshape(len(imgs), -1).sum(axis=1, dtype=np.float64) / (gray.size // len(imgs))
+
+
+@lru_cache(maxsize=4096)
+def gamma_lut(gamma, gain=1):
+    """
+    Cached lookup table of `torchvision.transforms.functional.adjust_gamma` for PIL images.
+    The returned array is read-only.
+    """
+    lut = np.array([int((255 + 1 - 1e-3) * gain * pow(ele / 255.0, gamma)) for ele in range(256)], dtype=np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+class LUTCorruption(BaseCorruption):
+    """
+    Base class of the point-wise intensity corruptions, applied through 256-entry lookup tables.
+    In augmentation mode, the intensities are quantized to `LUT_LEVELS` values, whose tables are cached.
+    """
+    libraries = ['cv2']
+
+    def sample_param(self, severity=-1, augmentation=False, rng=None):
+        return self.sample_batch_params(1, severity, augmentation, [get_rng(rng)])[0]
+
+    def sample_batch_params(self, num_images, severity=-1, augmentation=False, rng=None):
+        params = super().sample_batch_params(num_images, severity, augmentation, rng)
         if augmentation:
-            range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            correction_factor  = np.random.uniform(low=range_min, high=range_max, size=None)
-        else:
-            correction_factor = self.severity_params[severity]
-        
-        img = TF.adjust_gamma(img, correction_factor, gain=1)
-        return np.array(img).astype(np.uint8)
+            params = quantize(params, self.severity_params[0], self.severity_params[-1], LUT_LEVELS)
+        return params
+
+
+def shift_saturation(imgs, shifts):
+    """
+    Add `shifts` to the HSV saturation of uint8 RGB images, clipped to [0,1], as `Saturate` does with skimage. 
+    The whole batch is converted by two float32 `cv2.cvtColor` calls, stacking the images vertically.
+    Greyscale pixels get hue 0, as in skimage. The outputs differ from the skimage implementation 
+    by at most 1 gray level, on pixels whose exact value is close to an integer before truncation.
+
+    :param imgs: uint8 array of shape (N, H, W, 3).
+    :param shifts: Saturation shift of each image.
+    """
+    n, height, width, _ = imgs.shape
+    hsv = imgs.reshape(n * height, width, 3).astype(np.float32)
+    hsv *= np.float32(1 / 255.)
+    hsv = cv2.cvtColor(hsv, cv2.COLOR_RGB2HSV)
+
+    saturation = hsv.reshape(n, height * width, 3)[..., 1]
+    saturation += np.asarray(shifts, dtype=np.float32).reshape(-1, 1)
+    np.clip(saturation, 0, 1, out=saturation)
+
+    out = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+    np.clip(out, 0, 1, out=out)
+    out *= 255
+    return out.astype(np.uint8).reshape(imgs.shape)
+
+
+class Brightness(LUTCorruption):
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        brightness_factor = self.sample_param(severity, augmentation, rng)
+        return cv2.LUT(to_rgb_array(img), blend_lut(0, float(brightness_factor)))
+
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        brightness_factors = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        return apply_luts(imgs, blend_luts(0, brightness_factors))
+
+    def apply_tensor(self, imgs, severity=-1, augmentation=False, rng=None):
+        # Point-wise: greyscale batches are processed as they are
+        check_tensor(imgs)
+        brightness_factors = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        return gather_luts(imgs, blend_luts(0, brightness_factors))
+
+
+class Contrast(LUTCorruption):
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        contrast_factor = self.sample_param(severity, augmentation, rng)
+        img = to_rgb_array(img)
+        # As in PIL, the degenerate image is filled with the (rounded) mean of the greyscale image
+        mean = int(np.floor(grayscale_means(img[None])[0] + 0.5))
+        return cv2.LUT(img, blend_lut(mean, float(contrast_factor)))
+
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        contrast_factors = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        # As in PIL, the degenerate image is filled with the (rounded) mean of the greyscale image
+        means = np.floor(grayscale_means(imgs) + 0.5)
+        return apply_luts(imgs, blend_luts(means, contrast_factors))
+
+    def apply_tensor(self, imgs, severity=-1, augmentation=False, rng=None):
+        # Point-wise: greyscale batches are processed as they are
+        check_tensor(imgs)
+        contrast_factors = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        gray = grayscale_tensor(imgs) if imgs.shape[1] == 3 else imgs
+        means = gray.reshape(len(gray), -1).sum(dim=1).numpy() / gray[0].numel()
+        return gather_luts(imgs, blend_luts(np.floor(means + 0.5), contrast_factors))
+
+
+class GammaCorrection(LUTCorruption):
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        correction_factor = self.sample_param(severity, augmentation, rng)
+        return cv2.LUT(to_rgb_array(img), gamma_lut(float(correction_factor)))
+
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        correction_factors = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        luts = np.stack([gamma_lut(float(factor)) for factor in correction_factors])
+        return apply_luts(imgs, luts)
+
+    def apply_tensor(self, imgs, severity=-1, augmentation=False, rng=None):
+        # Point-wise: greyscale batches are processed as they are
+        check_tensor(imgs)
+        correction_factors = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        return gather_luts(imgs, np.stack([gamma_lut(float(factor)) for factor in correction_factors]))
 
 
 class Saturate(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
-        if augmentation:
-            range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            saturation_factor  = np.random.uniform(low=range_min, high=range_max, size=None)
-        else:
-            saturation_factor = self.severity_params[severity]
+    def __init__(self, severity_params, engine='opencv'):
+        """
+        :param severity_params: Saturation shift of each severity.
+        :param engine: `opencv` (float32, see `shift_saturation`) or `skimage`, i.e. the reference implementation.
+        """
+        super().__init__(severity_params)
+        assert engine in ['opencv', 'skimage'], f"Unknown engine {engine}."
+        self.engine = engine
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        saturation_factor = self.sample_param(severity, augmentation, rng)
+
+        if self.engine == 'opencv':
+            return shift_saturation(to_rgb_array(img)[None], [saturation_factor])[0]
         
-        img = np.array(img) / 255.
+        img = to_rgb_array(img) / 255.
         img = sk.color.rgb2hsv(img)
         img[:, :, 1] = np.clip(img[:, :, 1] + saturation_factor, 0, 1)
         img = sk.color.hsv2rgb(img)
@@ -58,3 +208,16 @@ class Saturate(BaseCorruption):
         
         return img.astype(np.uint8)
 
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        if self.engine != 'opencv':
+            return super().apply_batch(imgs, severity, augmentation, rng)
+        saturation_factors = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        return shift_saturation(imgs, saturation_factors)
+
+    def get_config(self):
+        config = super().get_config()
+        config['engine'] = self.engine
+        return config
+
+    def get_libraries(self):
+        return ['numpy', 'cv2' if self.engine == 'opencv' else 'skimage']
@@ -1,14 +1,23 @@
-from .base import BaseCorruption
+from .base import BaseCorruption, to_rgb_array, get_rng, image_rngs, uniform, quantize
+from .tensor import torch, check_tensor, group_by, filter_tensor
 
 from scipy.ndimage import zoom as scizoom
-from wand.image import Image as WandImage
-from wand.api import library as wandlibrary
-from io import BytesIO
+from functools import lru_cache
 
-import torchvision.transforms.functional as TF
 import numpy as np
 import cv2
 
+# Optional: ImageMagick is only required by the reference engine of `MotionBlur`
+try:
+    from wand.image import Image as WandImage
+    from wand.api import library as wandlibrary
+except ImportError:
+    WandImage = None
+
+# Number of levels of the radius and of the alias blur sampled by `DefocusBlur` in augmentation mode,
+# so that their kernels can be cached
+KERNEL_LEVELS = 64
+
 
 def disk(radius, alias_blur=0.1, dtype=np.float32):
     if radius <= 8:
@@ -23,6 +32,43 @@ def disk(radius, alias_blur=0.1, dtype=np.float32):
     return cv2.GaussianBlur(aliased_disk, ksize=ksize, sigmaX=alias_blur)
 
 
+@lru_cache(maxsize=KERNEL_LEVELS ** 2)
+def defocus_kernel(radius, alias_blur=0.1):
+    """
+    Cached `disk` kernel used by `DefocusBlur` (in augmentation mode, its parameters are quantized to
+    `KERNEL_LEVELS` values each, so the cache holds all of them). Entries that are negligible in float32 
+    (e.g. the tails of a small `alias_blur`) are zeroed, which also avoids slow denormal arithmetic, 
+    and the resulting zero border is cropped, since it does not contribute to the filtering.
+    The returned array is read-only.
+    """
+    kernel = disk(radius=radius, alias_blur=alias_blur)
+    kernel[kernel < np.finfo(np.float32).eps * kernel.max()] = 0
+
+    center = kernel.shape[0] // 2
+    rows, cols = np.nonzero(kernel)
+    half = max(np.abs(rows - center).max(), np.abs(cols - center).max())
+    kernel = np.ascontiguousarray(kernel[center - half:center + half + 1, center - half:center + half + 1])
+    kernel.flags.writeable = False
+    return kernel
+
+
+@lru_cache(maxsize=None)
+def gaussian_kernel(kernel_size, sigma=None):
+    """
+    Cached 1D Gaussian kernel of `torchvision.transforms.functional.gaussian_blur`, 
+    including its default sigma. The 2D kernel is its outer product, i.e. separable.
+    The returned array is read-only.
+    """
+    if sigma is None:
+        sigma = 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+    ksize_half = (kernel_size - 1) * 0.5
+    x = np.linspace(-ksize_half, ksize_half, kernel_size, dtype=np.float32)
+    pdf = np.exp(-0.5 * (x / np.float32(sigma)) ** 2)
+    kernel = pdf / pdf.sum()
+    kernel.flags.writeable = False
+    return kernel
+
+
 def clipped_zoom(img, zoom_factor):
     h = img.shape[0]
     ch = int(np.ceil(h / zoom_factor))
@@ -34,94 +80,297 @@ def clipped_zoom(img, zoom_factor):
     return img[trim_top:trim_top + h, trim_top:trim_top + h]
 
 
+@lru_cache(maxsize=256)
+def zoom_geometry(size, zoom_factor):
+    """
+    Cached linear interpolation geometry of `clipped_zoom` along one axis of length `size`: 
+    for each output pixel, the two source indices and their float32 weights.
+    As in `scipy.ndimage.zoom`, the corners of the central crop are aligned with the corners of the zoomed crop.
+    """
+    crop = int(np.ceil(size / zoom_factor))
+    top = (size - crop) // 2
+    zoomed = int(round(crop * zoom_factor))
+    trim_top = (zoomed - size) // 2
+
+    coords = np.arange(trim_top, trim_top + size, dtype=np.float64)
+    if zoomed > 1:
+        coords *= (crop - 1) / (zoomed - 1)
+    idx0 = np.floor(coords).astype(np.intp)
+    weights1 = coords - idx0
+    idx1 = np.minimum(idx0 + 1, crop - 1)
+
+    geometry = (idx0 + top, idx1 + top, (1 - weights1).astype(np.float32), weights1.astype(np.float32))
+    for array in geometry:
+        array.flags.writeable = False
+    return geometry
+
+
+def zoom_sum(img, zoom_factors):
+    """
+    Sum of `clipped_zoom(img, zoom_factor)` over `zoom_factors`, within float32 rounding. 
+    Each zoom is computed as two separable gathers with precomputed geometry (rows first, then columns)
+    in preallocated float32 buffers, with the image viewed as a (H, W * C) array.
+
+    :param img: float32 array of shape (H, W, C).
+    :param zoom_factors: Iterable of zoom factors.
+    """
+    height, width, channels = img.shape
+    src = img.reshape(height, width * channels)
+    rows, zoomed, tmp = np.empty_like(src), np.empty_like(src), np.empty_like(src)
+    out = np.zeros_like(src)
+
+    for zoom_factor in zoom_factors:
+        row0, row1, row_w0, row_w1 = zoom_geometry(height, zoom_factor)
+        col0, col1, col_w0, col_w1 = zoom_geometry(width, zoom_factor)
+
+        # interpolate the rows...
+        np.take(src, row0, axis=0, out=rows)
+        rows *= row_w0[:, None]
+        np.take(src, row1, axis=0, out=tmp)
+        tmp *= row_w1[:, None]
+        rows += tmp
+
+        # ... and then the columns, whose indices and weights are repeated over the channels
+        channel_offsets = np.arange(channels)
+        np.take(rows, (col0[:, None] * channels + channel_offsets).ravel(), axis=1, out=zoomed)
+        zoomed *= np.repeat(col_w0, channels)
+        np.take(rows, (col1[:, None] * channels + channel_offsets).ravel(), axis=1, out=tmp)
+        tmp *= np.repeat(col_w1, channels)
+        zoomed += tmp
+
+        out += zoomed
+
+    return out.reshape(height, width, channels)
+
+
+if WandImage is not None:
+    class MotionImage(WandImage):
+        def motion_blur(self, radius=0.0, sigma=0.0, angle=0.0):
+            wandlibrary.MagickMotionBlurImage(self.wand, radius, sigma, angle)
+
+
+@lru_cache(maxsize=128)
+def motion_blur_weights(radius, sigma):
+    """
+    Cached one-sided Gaussian weights of ImageMagick's `MotionBlurImage`, normalized to sum to one.
+    As in ImageMagick, the kernel width is `2 * ceil(radius) + 1`, or derived from `sigma` if `radius` is 0.
+    The returned array is read-only.
+    """
+    sigma = max(abs(sigma), 1e-12)
+    if radius > 1e-12:
+        width = int(2 * np.ceil(radius) + 1)
+    else:
+        # GetOptimalKernelWidth1D, i.e. the smallest width whose last weight is not perceptible (16-bit quantum)
+        width = 5
+        while True:
+            half = (width - 1) // 2
+            weights = np.exp(-np.arange(-half, half + 1) ** 2 / (2 * sigma ** 2))
+            if weights[-1] / weights.sum() < 1 / 65535:
+                break
+            width += 2
+        width -= 2
+
+    weights = np.exp(-np.arange(width) ** 2 / (2 * sigma ** 2))
+    weights /= weights.sum()
+    weights.flags.writeable = False
+    return weights
+
+
+def motion_blur_kernel(radius, sigma, angle):
+    """
+    Line kernel of ImageMagick's `MotionBlurImage`, as a list of (weight, dx, dy) triplets:
+    each output pixel is the weighted sum of the input pixels at (x + dx, y + dy). 
+    Taps falling on the same pixel are merged.
 
-class MotionImage(WandImage):
-    def motion_blur(self, radius=0.0, sigma=0.0, angle=0.0):
-        wandlibrary.MagickMotionBlurImage(self.wand, radius, sigma, angle)
+    :param radius: Radius of the blur (pixels).
+    :param sigma: Standard deviation of the Gaussian weights (pixels).
+    :param angle: Direction of the blur (degrees).
+    """
+    weights = motion_blur_weights(radius, sigma)
+    steps = np.arange(len(weights))
+    angle = np.deg2rad(angle)
+    dx = np.ceil(steps * np.cos(angle) - 0.5).astype(int)
+    dy = np.ceil(steps * np.sin(angle) - 0.5).astype(int)
+
+    kernel = {}
+    for weight, offset in zip(weights, zip(dx, dy)):
+        kernel[offset] = kernel.get(offset, 0) + weight
+    return [(weight, offset_x, offset_y) for (offset_x, offset_y), weight in kernel.items()]
+
+
+def motion_blur(img, radius, sigma, angle):
+    """
+    NumPy/OpenCV implementation of ImageMagick's motion blur (`MagickMotionBlurImage`), 
+    with replicated borders (ImageMagick's default edge virtual pixels). The shifted images 
+    are accumulated in float32 and rounded half up, so the output is expected to match 
+    ImageMagick within 1 gray level, on the pixels whose exact value is close to a half integer.
+
+    :param img: uint8 array of shape (H, W, C).
+    :param radius: Radius of the blur (pixels).
+    :param sigma: Standard deviation of the Gaussian weights (pixels).
+    :param angle: Direction of the blur (degrees).
+    """
+    height, width = img.shape[:2]
+    kernel = motion_blur_kernel(radius, sigma, angle)
+    dx = [offset_x for _, offset_x, _ in kernel]
+    dy = [offset_y for _, _, offset_y in kernel]
+    left, top = max(0, -min(dx)), max(0, -min(dy))
+    padded = cv2.copyMakeBorder(img, top, max(0, max(dy)), left, max(0, max(dx)), cv2.BORDER_REPLICATE).astype(np.float32)
+
+    out = np.zeros(img.shape, dtype=np.float32)
+    tmp = np.empty_like(out)
+    for weight, offset_x, offset_y in kernel:
+        shifted = padded[top + offset_y:top + offset_y + height, left + offset_x:left + offset_x + width]
+        np.multiply(shifted, np.float32(weight), out=tmp)
+        out += tmp
+
+    out += 0.5
+    np.floor(out, out=out)
+    return np.clip(out, 0, 255).astype(np.uint8)
 
 
 class GaussianBlur(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
+    libraries = ['cv2']
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        kernel = self.sample_kernel_size(severity, augmentation, get_rng(rng))
+
+        # Separable filtering with torchvision's reflect padding, rounded as torchvision does for uint8 images
+        kernel = gaussian_kernel(kernel)
+        img = cv2.sepFilter2D(to_rgb_array(img), cv2.CV_32F, kernel, kernel, borderType=cv2.BORDER_REFLECT_101)
+        return np.clip(np.rint(img), 0, 255).astype(np.uint8)
+
+    def apply_tensor(self, imgs, severity=-1, augmentation=False, rng=None):
+        # Linear on each channel: greyscale batches are processed as they are
+        check_tensor(imgs)
+        kernel_sizes = [self.sample_kernel_size(severity, augmentation, img_rng) for img_rng in image_rngs(rng, len(imgs))]
+        out = torch.empty_like(imgs)
+        for kernel_size, idx in group_by(kernel_sizes).items():
+            kernel = gaussian_kernel(kernel_size)
+            blurred = filter_tensor(filter_tensor(imgs[idx].to(torch.float32), kernel[None]), kernel[:, None])
+            out[idx] = blurred.round_().clamp_(0, 255).to(torch.uint8)
+        return out
+
+    def sample_kernel_size(self, severity, augmentation, rng):
         if augmentation:
             kernel_min, kernel_max = self.severity_params[0], self.severity_params[-1]
-            kernel = int(np.random.uniform(low=kernel_min, high=kernel_max, size=None))
+            kernel = int(uniform(rng, kernel_min, kernel_max))
             if kernel % 2 == 0: # it must be odd
                 kernel -= 1
         else:
             kernel = self.severity_params[severity]
-        img = TF.gaussian_blur(img, kernel_size=kernel)
-        return np.array(img).astype(np.uint8)
+        return kernel
 
 
 class MotionBlur(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
+    def __init__(self, severity_params, engine=None):
+        """
+        :param severity_params: (radius, sigma) of each severity.
+        :param engine: `native` (NumPy/OpenCV, see `motion_blur`) or `wand`, 
+                       i.e. the reference ImageMagick implementation, which requires Wand.
+                       If None, `wand` when Wand is installed, `native` otherwise.
+        """
+        super().__init__(severity_params)
+        if engine is None:
+            engine = 'native' if WandImage is None else 'wand'
+        assert engine in ['native', 'wand'], f"Unknown engine {engine}."
+        if engine == 'wand' and WandImage is None:
+            raise ImportError("The `wand` engine of MotionBlur requires Wand and ImageMagick (pip install medmnistc[wand]).")
+        self.engine = engine
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        rng = get_rng(rng)
         if augmentation:
             radius_min, radius_max = self.severity_params[0][0], self.severity_params[-1][0]
             sigma_min, sigma_max = self.severity_params[0][1], self.severity_params[-1][1]
-            radius  = np.random.uniform(low=radius_min, high=radius_max, size=None)
-            sigma = np.random.uniform(low=sigma_min, high=sigma_max, size=None)
+            radius  = uniform(rng, radius_min, radius_max)
+            sigma = uniform(rng, sigma_min, sigma_max)
         else:
             radius_sigma = self.severity_params[severity]
             radius, sigma = radius_sigma
 
-        output = BytesIO()
-        img.save(output, format='PNG')
-        img = MotionImage(blob=output.getvalue())
+        angle = uniform(rng, -45, 45)
+        img = to_rgb_array(img)
+
+        if self.engine == 'native':
+            return motion_blur(img, radius, sigma, angle)
+
+        _, png = cv2.imencode('.png', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+        img = MotionImage(blob=png.tobytes())
 
-        img.motion_blur(radius=radius, sigma=sigma, angle=np.random.uniform(-45, 45))
-        img = cv2.imdecode(np.fromstring(img.make_blob(), np.uint8),
+        img.motion_blur(radius=radius, sigma=sigma, angle=angle)
+        img = cv2.imdecode(np.frombuffer(img.make_blob(), np.uint8),
                         cv2.IMREAD_UNCHANGED)
-        
-        output.close()
 
-        if img.shape != (224, 224):
+        if img.ndim == 3:
             return np.clip(img[..., [2, 1, 0]], 0, 255).astype(np.uint8)  # BGR to RGB
         else:  # greyscale to RGB
             return np.clip(np.array([img, img, img]).transpose((1, 2, 0)), 0, 255).astype(np.uint8)
+
+    def get_config(self):
+        config = super().get_config()
+        config['engine'] = self.engine
+        return config
+
+    def get_libraries(self):
+        return ['numpy', 'cv2'] + (['wand'] if self.engine == 'wand' else [])
  
 
 class DefocusBlur(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
+    libraries = ['cv2']
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        radius, alias = self.sample_radius_alias(severity, augmentation, get_rng(rng))
+
+        img = to_rgb_array(img).astype(np.float32)
+        img /= 255.
+        kernel = defocus_kernel(radius, alias)
+
+        # Filter all the channels at once
+        out = cv2.filter2D(img, -1, kernel)
+        np.clip(out, 0, 1, out=out)
+        out *= 255
+
+        return out.astype(np.uint8)
+
+    def apply_tensor(self, imgs, severity=-1, augmentation=False, rng=None):
+        # Linear on each channel: greyscale batches are processed as they are
+        check_tensor(imgs)
+        params = [self.sample_radius_alias(severity, augmentation, img_rng) for img_rng in image_rngs(rng, len(imgs))]
+        out = torch.empty_like(imgs)
+        for (radius, alias), idx in group_by(params).items():
+            blurred = filter_tensor(imgs[idx].to(torch.float32) / 255., defocus_kernel(radius, alias))
+            out[idx] = blurred.clamp_(0, 1).mul_(255).to(torch.uint8)
+        return out
 
+    def sample_radius_alias(self, severity, augmentation, rng):
         if augmentation:
             radius_min, radius_max = self.severity_params[0][0], self.severity_params[-1][0]
             alias_min, alias_max = self.severity_params[0][1], self.severity_params[-1][1]
-            radius  = np.random.uniform(low=radius_min, high=radius_max, size=None)
-            alias = np.random.uniform(low=alias_min, high=alias_max, size=None)
+            radius = float(quantize(uniform(rng, radius_min, radius_max), radius_min, radius_max, KERNEL_LEVELS))
+            alias = float(quantize(uniform(rng, alias_min, alias_max), alias_min, alias_max, KERNEL_LEVELS))
         else:
             radius_alias = self.severity_params[severity]
             radius, alias = radius_alias        
-
-        img = np.array(img) / 255.
-        kernel = disk(radius=radius, alias_blur=alias)
-
-        channels = []
-        for d in range(3):
-            channels.append(cv2.filter2D(img[:, :, d], -1, kernel))
-        
-        channels = np.array(channels).transpose((1, 2, 0))  # 3x224x224 -> 224x224x3
-        out = np.clip(channels, 0, 1) * 255
-
-        return out.astype(np.uint8)
+        return radius, alias
     
 
 class ZoomBlur(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        rng = get_rng(rng)
 
         if augmentation: # hard code
             min_factor, max_factor, = 1.0, self.severity_params[-1][-1]
             min_step = self.severity_params[0][1] - self.severity_params[0][0]
             max_step = self.severity_params[-1][1] - self.severity_params[-1][0]
-            max_factor_sampled = np.random.uniform(low=min_factor, high=max_factor, size=None)
-            step = np.random.uniform(low=min_step, high=max_step, size=None)
+            max_factor_sampled = uniform(rng, min_factor, max_factor)
+            step = uniform(rng, min_step, max_step)
             zoom_factors = np.arange(min_factor, max_factor_sampled, step)
         else:
             zoom_factors = self.severity_params[severity]
 
-        img = (np.array(img) / 255.).astype(np.float32)
-        out = np.zeros_like(img)
-        for zoom_factor in zoom_factors:
-            out += clipped_zoom(img, zoom_factor)
+        img = (to_rgb_array(img) / 255.).astype(np.float32)
+        out = zoom_sum(img, zoom_factors)
 
         img = (img + out) / (len(zoom_factors) + 1)
         img = np.clip(img, 0, 1) * 255
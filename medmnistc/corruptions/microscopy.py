@@ -1,28 +1,34 @@
-from .base import BaseCorruption
+from .base import BaseCorruption, to_rgb_array, get_rng, image_rngs, uniform, load_inks
+from .tensor import torch, check_tensor
+from functools import lru_cache
 from PIL import Image, ImageDraw
 
 import numpy as np
-import random
 import cv2
 import string
-import random
 
 
 class StainDeposit(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
+    def __init__(self, severity_params):
+        super().__init__(severity_params)
+        # Decode the inks once, before any worker is forked
+        load_inks()
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        rng = get_rng(rng)
 
         if augmentation:
             range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            max_marks = int(np.random.uniform(low=range_min, high=range_max, size=None))
+            max_marks = int(uniform(rng, range_min, range_max))
         else:
             max_marks = self.severity_params[severity]
         
 
-        x = np.array(img) 
+        x = np.array(to_rgb_array(img))
         img_w, img_h = x.shape[1], x.shape[0]
             
         if max_marks > 1:
-            num_marks = random.randint(1,max_marks)
+            num_marks = int(rng.integers(1, max_marks, endpoint=True))
         else:
             num_marks = max_marks
 
@@ -30,128 +36,216 @@ class StainDeposit(BaseCorruption):
 
         for _ in range(num_marks):
 
-            ink = inks[random.randint(0,len(inks)-1)]
-            ink_height, ink_width = ink.shape
-            rand_x = random.randint(10,img_w - ink_width - 10) 
-            rand_y = random.randint(10,img_h - ink_height - 10) 
+            ink = inks[rng.integers(len(inks))]
+            ink_height, ink_width = ink.shape[:2]
+            rand_x = int(rng.integers(10, img_w - ink_width - 10, endpoint=True))
+            rand_y = int(rng.integers(10, img_h - ink_height - 10, endpoint=True))
 
-            for idx in range(3): #channels
-                x[rand_y: rand_y + ink_height, rand_x:rand_x + ink_width,idx] *= (1-ink) # black
+            # black, on all the channels at once
+            patch = x[rand_y: rand_y + ink_height, rand_x:rand_x + ink_width]
+            np.multiply(patch, 1 - ink, out=patch, casting='unsafe')
 
-        return np.clip(x, 0, 255).astype(np.uint8)
+        return x
     
 
-class Bubble(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
+@lru_cache(maxsize=128)
+def bubble_sprite(radius, border=2, alpha=100):
+    """
+    Cached alpha sprite of a bubble of radius `radius`, as drawn by `ImageDraw.ellipse` on a transparent 
+    canvas: `alpha` inside, `alpha + 30` on the border ring and 0 outside. Since PIL rasterizes the 
+    ellipses identically at any integer position, a bubble centered in (x,y) is this sprite placed at 
+    (x - radius - border, y - radius - border). The returned array is read-only.
+    """
+    size = 2 * (radius + border) + 1
+    sprite = Image.new('L', (size, size), 0)
+    draw = ImageDraw.Draw(sprite)
+    draw.ellipse((0, 0, size - 1, size - 1), fill=alpha + 30)
+    draw.ellipse((border, border, border + 2 * radius, border + 2 * radius), fill=alpha)
+    sprite = np.array(sprite)
+    sprite.flags.writeable = False
+    return sprite
+
+
+def draw_bubbles(img, bubbles, border=2, alpha=100):
+    """
+    Overlay white bubbles on `img` in place, bit-exact with drawing them with `ImageDraw` on a 
+    transparent RGBA canvas and pasting it with PIL. The sprites overwrite each other in order, 
+    as PIL does, into an opacity map, which is then blended in a single pass: PIL's 
+    (v * (255 - a) + 255 * a) / 255, rounded, equals 255 - round((255 - v) * (255 - a) / 255).
+
+    :param img: Writable uint8 array of shape (H, W, C).
+    :param bubbles: Sequence of (x, y, radius).
+    """
+    height, width = img.shape[:2]
+    opacity = np.zeros((height, width), dtype=np.uint8)
+    for x, y, radius in bubbles:
+        sprite = bubble_sprite(radius, border, alpha)
+        x0, y0 = x - radius - border, y - radius - border
+        # clip the sprite to the image
+        sx0, sy0 = max(0, -x0), max(0, -y0)
+        sx1, sy1 = min(sprite.shape[1], width - x0), min(sprite.shape[0], height - y0)
+        sprite = sprite[sy0:sy1, sx0:sx1]
+        region = opacity[y0 + sy0:y0 + sy1, x0 + sx0:x0 + sx1]
+        np.copyto(region, sprite, where=sprite > 0)
+
+    channels = img.shape[2] if img.ndim == 3 else 1
+    transparency = cv2.merge([255 - opacity] * channels)
+    img[...] = 255 - cv2.multiply(255 - img, transparency, scale=1 / 255.).reshape(img.shape)
+    return img
+
 
+class Bubble(BaseCorruption):
+    libraries = ['PIL', 'cv2']
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        return self.draw(np.array(to_rgb_array(img)), severity, augmentation, get_rng(rng))
+
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        # A single working buffer for the whole batch, each image is written in place
+        out = np.array(imgs, dtype=np.uint8)
+        for img, img_rng in zip(out, image_rngs(rng, len(out))):
+            self.draw(img, severity, augmentation, img_rng)
+        return out
+
+    def draw(self, img, severity, augmentation, rng):
+        """
+        Draw the random bubbles in place on `img`, a writable uint8 array of shape (H, W, 3).
+        """
         if augmentation:
             range_min_rad, range_max_rad = self.severity_params[0][0], self.severity_params[-1][0]
             range_min_bub, range_max_bub = self.severity_params[0][1], self.severity_params[-1][1]
-            max_radius = int(np.random.uniform(low=range_min_rad, high=range_max_rad, size=None))
-            max_bubbles = int(np.random.uniform(low=range_min_bub, high=range_max_bub, size=None))
+            max_radius = int(uniform(rng, range_min_rad, range_max_rad))
+            max_bubbles = int(uniform(rng, range_min_bub, range_max_bub))
         else:
             maxradius_bubbles = self.severity_params[severity]
             max_radius, max_bubbles = maxradius_bubbles
 
-        height, width = img.size
-        output_image = img.copy()
-
-        # create a new image for the bubbles with the same dimensions as the original image
-        # and transparent background (RGBA mode)
-        bubbles_image = Image.new('RGBA', output_image.size, (255, 255, 255, 0))
-        # create a drawing context for the bubble image
-        draw = ImageDraw.Draw(bubbles_image)
-        # define border effect of the bubble
-        border = 2
+        height, width = img.shape[:2]
 
-        num_bubbles = random.randint(7,max_bubbles)
+        num_bubbles = int(rng.integers(7, max_bubbles, endpoint=True))
 
-        # draw several bubbles
+        # sample several bubbles
+        bubbles = []
         for _ in range(num_bubbles):  
-            radius = random.randint(3, max_radius)  # random radius
-            x, y = random.randint(radius, width - radius), random.randint(radius, height - radius)
-            alpha = 100 # transparency
-            draw.ellipse((x - radius - border, y - radius - border, x + radius + border, y + radius + border), fill=(255, 255, 255, alpha + 30))
-            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=(255, 255, 255, alpha))
+            radius = int(rng.integers(3, max_radius, endpoint=True))  # random radius
+            x, y = int(rng.integers(radius, width - radius, endpoint=True)), int(rng.integers(radius, height - radius, endpoint=True))
+            bubbles.append((x, y, radius))
 
         # overlay the bubbles onto the original image
-        output_image.paste(bubbles_image, (0, 0), bubbles_image)
-        return np.array(output_image)
+        return draw_bubbles(img, bubbles)
     
 
-class BlackCorner(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
-        if augmentation:
-            range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            multiplier = np.random.uniform(low=range_min, high=range_max, size=None)
-        else:
-            multiplier = self.severity_params[severity]
-            
-        width, height = img.size
-        img = np.array(img)
-        
-        center = (width // 2, height // 2)
-        
-        # default radius
-        radius = min(center[0], center[1], width - center[0], height - center[1])
-        # adjust radius based on the severity / aug
-        circle = np.zeros((height, width), np.uint8)
-        cv2.circle(circle, center, int(radius * multiplier), (255), thickness=-1)
-        mask = circle == 255
-        img[~mask] = 0
+@lru_cache(maxsize=1024)
+def circle_mask(height, width, radius):
+    """
+    Cached uint8 mask (H, W) of `BlackCorner`: 1 inside the centered circle of radius `radius`, 0 outside.
+    The returned array is read-only.
+    """
+    center = (width // 2, height // 2)
+    circle = np.zeros((height, width), np.uint8)
+    cv2.circle(circle, center, radius, (1), thickness=-1)
+    circle.flags.writeable = False
+    return circle
+
+
+def corner_mask(height, width, multiplier):
+    """
+    Mask of the pixels kept by `BlackCorner` (see `circle_mask`). It only depends on the 
+    size and on the (integer) radius of the circle, so that the masks are cached.
+    """
+    center = (width // 2, height // 2)
+    
+    # default radius
+    radius = min(center[0], center[1], width - center[0], height - center[1])
+    # adjust radius based on the severity / aug
+    return circle_mask(height, width, int(radius * multiplier))
 
-        return img
 
+class BlackCorner(BaseCorruption):
+    libraries = ['cv2']
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        multiplier = self.sample_param(severity, augmentation, rng)
+        img = to_rgb_array(img)
+        # zero the pixels outside the circle
+        return cv2.bitwise_and(img, img, mask=corner_mask(img.shape[0], img.shape[1], multiplier))
+
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        multipliers = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        height, width = imgs.shape[1], imgs.shape[2]
+        # the pixels outside the masks are left untouched, i.e. zero
+        out = np.zeros_like(imgs)
+        for img, multiplier, img_out in zip(imgs, multipliers, out):
+            cv2.bitwise_and(img, img, dst=img_out, mask=corner_mask(height, width, multiplier))
+        return out
+
+    def apply_tensor(self, imgs, severity=-1, augmentation=False, rng=None):
+        # Point-wise: greyscale batches are processed as they are
+        check_tensor(imgs)
+        multipliers = self.sample_batch_params(len(imgs), severity, augmentation, rng)
+        height, width = imgs.shape[2:]
+        masks = np.stack([corner_mask(height, width, multiplier) for multiplier in multipliers])
+        return imgs * torch.from_numpy(masks).unsqueeze(1)
 
-class Characters(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
 
+class Characters(BaseCorruption):
+    libraries = ['cv2']
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        return self.draw(np.array(to_rgb_array(img)), severity, augmentation, get_rng(rng))
+
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        # A single working buffer for the whole batch, each image is written in place
+        out = np.array(imgs, dtype=np.uint8)
+        for img, img_rng in zip(out, image_rngs(rng, len(out))):
+            self.draw(img, severity, augmentation, img_rng)
+        return out
+
+    def draw(self, img, severity, augmentation, rng):
+        """
+        Draw the random strings in place on `img`, a writable, contiguous uint8 array of shape (H, W, 3).
+        """
         if augmentation:
 
             range_min_w, range_max_w = self.severity_params[0][0], self.severity_params[-1][0]
             range_min_l, range_max_l = self.severity_params[0][1], self.severity_params[-1][1]
             range_min_fs, range_max_fs = self.severity_params[0][2], self.severity_params[-1][2]
-            max_words = int(np.random.uniform(low=range_min_w, high=range_max_w, size=None))
-            max_letters = int(np.random.uniform(low=range_min_l, high=range_max_l, size=None))
-            max_font_scale = np.random.uniform(low=range_min_fs, high=range_max_fs, size=None)
+            max_words = int(uniform(rng, range_min_w, range_max_w))
+            max_letters = int(uniform(rng, range_min_l, range_max_l))
+            max_font_scale = uniform(rng, range_min_fs, range_max_fs)
 
         else:
 
             c = self.severity_params[severity]
             max_words, max_letters, max_font_scale = c
         
-        num_words = random.randint(1,max_words)
+        num_words = int(rng.integers(1, max_words, endpoint=True))
+        letters = string.ascii_lowercase
+        width, height = img.shape[1], img.shape[0]
 
         for _ in range(num_words):
 
-            num_letters = random.randint(3,max_letters)
-            font_scale = random.randint(14,int(max_font_scale * 100)) / 100.
-
-            letters = string.ascii_lowercase
-            random_str = ''.join(random.choice(letters) for _ in range(num_letters))
-
-            img = np.array(img)
+            num_letters = int(rng.integers(3, max_letters, endpoint=True))
+            font_scale = int(rng.integers(14, int(max_font_scale * 100), endpoint=True)) / 100.
 
-            width, height = img.shape[1], img.shape[0]
+            random_str = ''.join(letters[idx] for idx in rng.integers(len(letters), size=num_letters))
 
-            # randomly sample the position of the string with respect to the image
+            # randomly sample the position of the string with respect to the image
             # org = (x,y) represents the bottom left corner
-            rand_x = random.randint(10,width - (8 * num_letters))
-            rand_y = random.randint(10,height - 10)
+            rand_x = int(rng.integers(10, width - (8 * num_letters), endpoint=True))
+            rand_y = int(rng.integers(10, height - 10, endpoint=True))
             org = (rand_x,rand_y) 
         
             # black character
-            color = self.random_color()
+            color = self.random_color(rng)
             thickness = 1
             
-            img = cv2.putText(img, random_str, org, self.font,  
+            cv2.putText(img, random_str, org, self.font,  
                         font_scale, color, thickness, cv2.LINE_AA)
         
         return img
     
 
-    def random_color(self):
-        red = random.randint(0, 255)
-        green = random.randint(0, 255)
-        blue = random.randint(0, 255)
+    def random_color(self, rng):
+        red, green, blue = rng.integers(0, 255, size=3, endpoint=True).tolist()
         return (red, green, blue)
\ No newline at end of file
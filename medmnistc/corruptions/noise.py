@@ -1,57 +1,132 @@
-from .base import BaseCorruption
+from .base import BaseCorruption, to_rgb_array, thread_map, image_rngs, get_rng
+from .tensor import (check_tensor, to_rgb_tensor, restore_channels, torch_generator, gaussian_noise_tensor, 
+                     speckle_noise_tensor, shot_noise_tensor, impulse_noise_tensor)
 
-import skimage as sk
 import numpy as np
+import threading
 
 
-class GaussianNoise(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
-        if augmentation:
-            range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            c  = np.random.uniform(low=range_min, high=range_max, size=None)
-        else:
-            c = self.severity_params[severity]
-        
-        img = np.array(img) / 255.
-        noisy_image = np.clip(img + np.random.normal(size=img.shape, scale=c), 0, 1)
-        return (noisy_image * 255).astype(np.uint8)
-
-
-class ImpulseNoise(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
-        if augmentation:
-            range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            c  = np.random.uniform(low=range_min, high=range_max, size=None)
-            noisy_image = sk.util.random_noise(np.array(img) / 255., mode='s&p', amount=c, rng=np.random.default_rng(99999))
-        else:
-            c = self.severity_params[severity]
-            noisy_image = sk.util.random_noise(np.array(img) / 255., mode='s&p', amount=c, rng=self.rng)
-        noisy_image = np.clip(noisy_image, 0, 1)
-        return (noisy_image * 255).astype(np.uint8)
-
-
-class SpeckleNoise(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
-        if augmentation:
-            range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            c  = np.random.uniform(low=range_min, high=range_max, size=None)
-        else:
-            c = self.severity_params[severity]
-        img = np.array(img) / 255.
-        noise = np.random.normal(size=img.shape, scale=c)
-        noisy_image = np.clip(img + img * noise, 0, 1)
-        return (noisy_image * 255).astype(np.uint8)
-
-
-class ShotNoise(BaseCorruption):
-    def apply(self, img, severity=-1, augmentation=False):
-        if augmentation:
-            range_min, range_max = self.severity_params[0], self.severity_params[-1]
-            mult  = np.random.uniform(low=range_min, high=range_max, size=None)
-        else:
-            mult = self.severity_params[severity]
-        img = np.array(img) / 255.
-        noisy_image = np.clip(np.random.poisson(img * mult) / mult, 0, 1)
-        return (noisy_image * 255).astype(np.uint8)
-    
+# Thread-local float32 scratch buffers of the noise engine, reused across calls
+_SCRATCH = threading.local()
 
+
+def scratch_buffer(shape, slot=0):
+    """
+    Thread-local float32 buffer of the given shape, allocated once and reused by the following calls.
+
+    :param shape: Shape of the buffer.
+    :param slot: Index of the buffer, to get several buffers of the same shape.
+    """
+    if not hasattr(_SCRATCH, 'buffers'):
+        _SCRATCH.buffers = {}
+    key = (slot, tuple(shape))
+    if key not in _SCRATCH.buffers:
+        _SCRATCH.buffers[key] = np.empty(shape, dtype=np.float32)
+    return _SCRATCH.buffers[key]
+
+
+def to_uint8(img):
+    """
+    Clip a float32 image in [0,1] (in place) and quantize it to uint8, truncating as the corruptions do.
+    """
+    np.clip(img, 0, 1, out=img)
+    img *= 255
+    return img.astype(np.uint8)
+
+
+def gaussian_noise(img, scale, rng):
+    """
+    Additive Gaussian noise with standard deviation `scale`, on the image in [0,1].
+    """
+    out, noise = scratch_buffer(img.shape, 0), scratch_buffer(img.shape, 1)
+    np.multiply(img, np.float32(1 / 255.), out=out)
+    rng.standard_normal(dtype=np.float32, out=noise)
+    noise *= np.float32(scale)
+    out += noise
+    return to_uint8(out)
+
+
+def speckle_noise(img, scale, rng):
+    """
+    Multiplicative Gaussian noise with standard deviation `scale`, on the image in [0,1].
+    """
+    out, noise = scratch_buffer(img.shape, 0), scratch_buffer(img.shape, 1)
+    np.multiply(img, np.float32(1 / 255.), out=out)
+    rng.standard_normal(dtype=np.float32, out=noise)
+    noise *= np.float32(scale)
+    noise *= out
+    out += noise
+    return to_uint8(out)
+
+
+def shot_noise(img, mult, rng):
+    """
+    Poisson noise, with `mult` photons for a pixel at full intensity.
+    """
+    out = scratch_buffer(img.shape, 0)
+    np.multiply(img, np.float32(mult / 255.), out=out)
+    np.divide(rng.poisson(out), mult, out=out)
+    return to_uint8(out)
+
+
+def impulse_noise(img, amount, rng):
+    """
+    Salt & pepper noise replacing a proportion `amount` of the values, half with 255 and half with 0,
+    as `skimage.util.random_noise(..., mode='s&p')`. It works in the uint8 space, and a single uniform
+    draw per value selects both the flipped values (u < amount) and their polarity (u < amount / 2).
+    """
+    uniform = scratch_buffer(img.shape, 0)
+    rng.random(dtype=np.float32, out=uniform)
+
+    out = img.copy()
+    out[uniform < amount] = 0
+    out[uniform < amount / 2] = 255
+    return out
+
+
+class NoiseCorruption(BaseCorruption):
+    """
+    Base class of the noise corruptions, built on a per-image noise function `noise(img, param, rng)`.
+    The noise is drawn from the generator of each image (see `image_rng`), in float32 scratch buffers.
+    The tensor backend uses the batch function `noise_tensor(imgs, params, generator)`, whose noise is drawn
+    by torch: it is reproducible given `rng`, but differs from the one of `apply_batch`.
+    """
+    noise = None
+    noise_tensor = None
+
+    def apply(self, img, severity=-1, augmentation=False, rng=None):
+        rng = get_rng(rng)
+        param = self.sample_param(severity, augmentation, rng)
+        return type(self).noise(to_rgb_array(img), param, rng)
+
+    def apply_batch(self, imgs, severity=-1, augmentation=False, rng=None):
+        rngs = image_rngs(rng, len(imgs))
+        params = self.sample_batch_params(len(imgs), severity, augmentation, rngs)
+        return np.stack(thread_map(type(self).noise, imgs, params, rngs))
+
+    def apply_tensor(self, imgs, severity=-1, augmentation=False, rng=None):
+        check_tensor(imgs)
+        rngs = image_rngs(rng, len(imgs))
+        params = self.sample_batch_params(len(imgs), severity, augmentation, rngs)
+        out = type(self).noise_tensor(to_rgb_tensor(imgs), params, torch_generator(rngs))
+        return restore_channels(out, imgs.shape[1])
+
+
+class GaussianNoise(NoiseCorruption):
+    noise = gaussian_noise
+    noise_tensor = gaussian_noise_tensor
+
+
+class ImpulseNoise(NoiseCorruption):
+    noise = impulse_noise
+    noise_tensor = impulse_noise_tensor
+
+
+class SpeckleNoise(NoiseCorruption):
+    noise = speckle_noise
+    noise_tensor = speckle_noise_tensor
+
+
+class ShotNoise(NoiseCorruption):
+    noise = shot_noise
+    noise_tensor = shot_noise_tensor
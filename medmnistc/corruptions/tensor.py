@@ -0,0 +1,170 @@
+import numpy as np
+
+try:
+    import torch
+    import torch.nn.functional as F
+except ImportError: # the tensor backend is optional
+    torch = None
+
+
+# Fixed-point precision of PIL's resampling coefficients (see `box_downscale_weights`)
+PRECISION_BITS = 22
+
+
+def check_tensor(imgs):
+    """
+    Check that `imgs` is a batch of images accepted by the tensor backend,
+    i.e. a uint8 CPU tensor of shape [B, C, H, W] with C = 1 (greyscale) or 3 (RGB).
+    """
+    if torch is None:
+        raise ImportError("The tensor backend of the corruptions requires PyTorch.")
+    assert isinstance(imgs, torch.Tensor), f"Expected a torch.Tensor, got {type(imgs)}"
+    assert imgs.dtype == torch.uint8 and imgs.device.type == 'cpu', f"Expected a uint8 CPU tensor, got {imgs.dtype} on {imgs.device}"
+    assert imgs.ndim == 4 and imgs.shape[1] in [1, 3], f"Expected a tensor [B,C,H,W] with 1 or 3 channels, got {tuple(imgs.shape)}"
+
+
+def to_rgb_tensor(imgs):
+    """
+    RGB view [B, 3, H, W] of a batch, replicating greyscale images over the channels (no copy).
+    """
+    return imgs.expand(-1, 3, -1, -1)
+
+
+def grayscale_tensor(imgs):
+    """
+    Convert RGB tensors [B, 3, H, W] to greyscale [B, 1, H, W], bit-exact with PIL's `convert('L')`.
+    """
+    weights = torch.tensor([19595, 38470, 7471], dtype=torch.int64).view(1, 3, 1, 1)
+    gray = (imgs.to(torch.int64) * weights).sum(dim=1, keepdim=True)
+    return ((gray + 0x8000) >> 16).to(torch.uint8)
+
+
+def restore_channels(imgs, channels):
+    """
+    Convert the RGB outputs [B, 3, H, W] of a corruption back to greyscale if the inputs had 1 channel,
+    as `DatasetManager` does.
+    """
+    return grayscale_tensor(imgs) if channels == 1 else imgs
+
+
+def tensor_to_array(imgs):
+    """
+    Contiguous uint8 RGB array (B, H, W, 3) of a batch [B, C, H, W], as expected by `apply_batch`.
+    """
+    return np.ascontiguousarray(to_rgb_tensor(imgs).permute(0, 2, 3, 1).numpy())
+
+
+def array_to_tensor(imgs, channels):
+    """
+    Contiguous uint8 tensor [B, C, H, W] of the RGB outputs (B, H, W, 3) of `apply_batch`.
+    """
+    return restore_channels(torch.from_numpy(imgs).permute(0, 3, 1, 2), channels).contiguous()
+
+
+def torch_generator(rngs):
+    """
+    `torch.Generator` seeded from the numpy generators of the images of a batch.
+    """
+    seeds = [int(rng.integers(2**63)) for rng in rngs]
+    seed = int(np.random.SeedSequence(seeds).generate_state(1, dtype=np.uint64)[0])
+    return torch.Generator().manual_seed(seed)
+
+
+def group_by(params):
+    """
+    Indices of the images of a batch sharing the same parameters, as {params: int64 index tensor}.
+
+    :param params: Hashable parameters of each image.
+    """
+    groups = {}
+    for idx, param in enumerate(params):
+        groups.setdefault(param, []).append(idx)
+    return {param: torch.tensor(idx, dtype=torch.int64) for param, idx in groups.items()}
+
+
+def gather_luts(imgs, luts):
+    """
+    Apply one lookup table per image, as `apply_luts` does for arrays.
+
+    :param imgs: uint8 tensor [B, C, H, W].
+    :param luts: uint8 array of shape (B, 256).
+    """
+    luts = torch.tensor(luts, dtype=torch.uint8)
+    index = imgs.reshape(len(imgs), -1).to(torch.int64)
+    return torch.gather(luts, 1, index).reshape(imgs.shape)
+
+
+def filter_tensor(imgs, kernel):
+    """
+    Correlate each channel of a float32 tensor [B, C, H, W] with a 2D kernel, with OpenCV's default
+    border (`BORDER_REFLECT_101`), through a depthwise `conv2d`.
+
+    :param imgs: float32 tensor [B, C, H, W].
+    :param kernel: float32 array of shape (kh, kw), with odd sizes.
+    """
+    kernel = torch.tensor(kernel, dtype=torch.float32)
+    kernel_height, kernel_width = kernel.shape
+    channels = imgs.shape[1]
+    padded = F.pad(imgs, (kernel_width // 2, kernel_width // 2, kernel_height // 2, kernel_height // 2), mode='reflect')
+    return F.conv2d(padded, kernel.view(1, 1, kernel_height, kernel_width).repeat(channels, 1, 1, 1), groups=channels)
+
+
+def box_resize_tensor(imgs, weights_y, weights_x):
+    """
+    Separable resampling of a uint8 tensor [B, C, H, W] with PIL's fixed-point coefficients: a horizontal
+    then a vertical pass, each rounded and clipped to uint8, as PIL does. The float64 matrix products are
+    exact, since all the intermediate values are integers below 2**53.
+
+    :param weights_y: Coefficients (out_height, H), scaled by 2**PRECISION_BITS.
+    :param weights_x: Coefficients (out_width, W), scaled by 2**PRECISION_BITS.
+    """
+    def rescale(values):
+        values += 1 << (PRECISION_BITS - 1)
+        values /= 1 << PRECISION_BITS
+        return values.floor_().clamp_(0, 255)
+
+    out = rescale(torch.matmul(imgs.to(torch.float64), torch.tensor(weights_x).t()))
+    out = rescale(torch.matmul(torch.tensor(weights_y), out))
+    return out.to(torch.uint8)
+
+
+def gaussian_noise_tensor(imgs, scales, generator):
+    """
+    Tensor version of `gaussian_noise`, for a batch [B, 3, H, W] with one scale per image.
+    """
+    out = imgs.to(torch.float32) * (1 / 255.)
+    noise = torch.randn(out.shape, generator=generator, dtype=torch.float32)
+    noise *= torch.tensor(scales, dtype=torch.float32).view(-1, 1, 1, 1)
+    out += noise
+    return out.clamp_(0, 1).mul_(255).to(torch.uint8)
+
+
+def speckle_noise_tensor(imgs, scales, generator):
+    """
+    Tensor version of `speckle_noise`, for a batch [B, 3, H, W] with one scale per image.
+    """
+    out = imgs.to(torch.float32) * (1 / 255.)
+    noise = torch.randn(out.shape, generator=generator, dtype=torch.float32)
+    noise *= torch.tensor(scales, dtype=torch.float32).view(-1, 1, 1, 1)
+    noise *= out
+    out += noise
+    return out.clamp_(0, 1).mul_(255).to(torch.uint8)
+
+
+def shot_noise_tensor(imgs, mults, generator):
+    """
+    Tensor version of `shot_noise`, for a batch [B, 3, H, W] with one number of photons per image.
+    """
+    mults = torch.tensor(mults, dtype=torch.float32).view(-1, 1, 1, 1)
+    out = torch.poisson(imgs.to(torch.float32) * (mults / 255.), generator=generator)
+    out /= mults
+    return out.clamp_(0, 1).mul_(255).to(torch.uint8)
+
+
+def impulse_noise_tensor(imgs, amounts, generator):
+    """
+    Tensor version of `impulse_noise`, for a batch [B, 3, H, W] with one amount per image.
+    """
+    uniform = torch.rand(imgs.shape, generator=generator, dtype=torch.float32)
+    amounts = torch.tensor(amounts, dtype=torch.float32).view(-1, 1, 1, 1)
+    return imgs.masked_fill(uniform < amounts, 0).masked_fill_(uniform < amounts / 2, 255)
@@ -1,8 +1,10 @@
+from medmnistc.utils.storage import load_corrupted_test_set
 from torchvision import transforms
 from torch.utils.data import Dataset
 from PIL import Image
 
 import numpy as np
+import torch
 import os
 
 
@@ -14,7 +16,9 @@ class CorruptedMedMNIST(Dataset):
                  norm_std : list = [0.5],
                  root : str = None,
                  as_rgb : bool = True,
-                 mmap_mode : str = None):
+                 mmap_mode : str = None,
+                 as_uint8 : bool = False,
+                 cache_dir : str = None):
         """
         Dataset class of CorruptedMedMNIST
 
@@ -30,6 +34,16 @@ class CorruptedMedMNIST(Dataset):
                           Memory mapping is especially useful for accessing small 
                           fragments of large files without reading the entire file into memory.
                           src: https://numpy.org/doc/stable/reference/generated/numpy.load.html
+                          Note: compressed `npz` files cannot be memory-mapped (see `cache_dir`), while 
+                          the `npy` storage format (see `DatasetManager`) is always memory-mapped.
+        :param as_uint8: If True, return uint8 tensors [C, H, W] in [0, 255], without normalization 
+                         (left to the model, e.g. `(x.float() / 255 - mean) / std` on the GPU). 
+                         It reduces the per-sample work and the memory traffic of the loader.
+        :param cache_dir: If given, the compressed `npz` files (e.g. the ones hosted on Zenodo) are decompressed 
+                          once into raw `.npy` files under {cache_dir} / {dataset}, which are then memory-mapped.
+                          The cache is built atomically and under a lock shared by the processes, so that the 
+                          later opens, from any process or DataLoader worker, start instantly and share the 
+                          pages of the OS cache rather than holding their own copy in RAM.
         
         This dataset class was greatly inspired from the MedMNIST APIs:
             https://github.com/MedMNIST/MedMNIST
@@ -41,6 +55,7 @@ class CorruptedMedMNIST(Dataset):
         self.corruption = corruption
         self.root = root
         self.as_rgb = as_rgb
+        self.as_uint8 = as_uint8
         
         if root is not None and os.path.exists(root):
             self.root = root
@@ -50,23 +65,21 @@ class CorruptedMedMNIST(Dataset):
                 + "Please specify and create the `root` directory manually."
             )
         
-        if not os.path.exists(os.path.join(self.root, self.dataset_name, f"{corruption}.npz")):
+        if not any(os.path.exists(os.path.join(self.root, self.dataset_name, f"{corruption}.{ext}")) for ext in ["npz", "npy"]):
             print(os.path.join(self.root, self.dataset_name, f"{corruption}.npz"))
             raise RuntimeError(
                 "Dataset not found."
             )
 
-        npz_file = np.load(
-            os.path.join(self.root, self.dataset_name, f"{corruption}.npz"),
-            mmap_mode=mmap_mode,
-        )
-        
-        self.imgs = npz_file["test_images"]
-        self.labels = npz_file["test_labels"]
+        self.imgs, self.labels = load_corrupted_test_set(self.root, self.dataset_name, corruption, mmap_mode, cache_dir)
         self.transform = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize(mean=norm_mean, std=norm_std) 
         ])
+        # Transform reproduced by the vectorized path of `__getitems__`
+        self._batched_transform = self.transform
+        self._norm_mean = torch.tensor(norm_mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self._norm_std = torch.tensor(norm_std, dtype=torch.float32).view(1, -1, 1, 1)
     
     
     def __len__(self):
@@ -75,6 +88,10 @@ class CorruptedMedMNIST(Dataset):
     
     def __getitem__(self, index):
         img, target = self.imgs[index], self.labels[index].astype(int)
+
+        if self.as_uint8:
+            return self._to_tensor(np.asarray(img)[None])[0], target
+
         img = Image.fromarray(img)
 
         if self.as_rgb:
@@ -83,4 +100,43 @@ class CorruptedMedMNIST(Dataset):
         if self.transform is not None:
             img = self.transform(img)
 
-        return img, target
\ No newline at end of file
+        return img, target
+
+
+    def __getitems__(self, indices):
+        """
+        Batched version of `__getitem__`, used by the DataLoader (PyTorch >= 2.2) to fetch a whole batch at once:
+        the images are gathered with a single slice of the (memory-mapped) array, and the channel expansion, 
+        `ToTensor` and `Normalize` run as one vectorized operation on the batch, with the same results.
+        With a custom `transform`, the samples are fetched one by one.
+
+        :param indices: Indices of the samples of the batch.
+        :return: List of (image, target) samples, as expected by the `collate_fn`.
+        """
+        if not self.as_uint8 and self.transform is not self._batched_transform:
+            return [self[index] for index in indices]
+
+        indices = np.asarray(indices, dtype=np.int64)
+        imgs = self._to_tensor(np.asarray(self.imgs[indices]))
+        targets = self.labels[indices].astype(int)
+        return list(zip(imgs, targets))
+
+
+    def _to_tensor(self, imgs):
+        """
+        Convert a batch of uint8 images (B, H, W[, C]) into a tensor [B, C, H, W], replicating greyscale images 
+        over 3 channels if `as_rgb`. As `ToTensor` and `Normalize`, the images are scaled to [0,1] 
+        and normalized in float32, unless `as_uint8`.
+        """
+        if imgs.ndim == 3:
+            imgs = imgs[..., None]
+
+        imgs = torch.from_numpy(np.require(imgs, np.uint8, ['C', 'W'])).permute(0, 3, 1, 2)
+        if self.as_rgb and imgs.shape[1] == 1:
+            imgs = imgs.expand(-1, 3, -1, -1)
+
+        if self.as_uint8:
+            return imgs.contiguous()
+
+        imgs = imgs.contiguous().to(torch.float32).div_(255)
+        return imgs.sub_(self._norm_mean).div_(self._norm_std)
@@ -1,18 +1,100 @@
 from medmnistc.corruptions.registry import CORRUPTIONS_DS, DATASET_RGB
-from medmnistc.utils.utils import seed_everything
+from medmnistc.corruptions.base import to_grayscale, image_rng
+from medmnistc.utils.utils import derive_seed
+from medmnistc.utils.storage import save_npz, save_npy, save_npy_chunks, save_json, extract_npz_member, file_checksum
+from medmnistc.utils.parallel import WORKER_STATE, worker_pool, imap_bounded
+from medmnistc import __version__
 from medmnist import INFO
-from PIL import Image
+import importlib
+import json
 import numpy as np
 import os 
 
 from tqdm import tqdm
 
 
+# Scheme of the random streams, recorded in the manifest: outputs made with another scheme are stale.
+_SEEDING = 'per-sample-philox'
+
+# Rough peak memory of one image while being corrupted, relative to its RGB uint8 size 
+# (clean RGB copy, float64 intermediates of the corruptions and output).
+_IMAGE_MEMORY_FACTOR = 16
+
+
+def sample_rng(random_seed, dataset_name, corruption, severity, index):
+    """
+    Generator of the corrupted sample keyed by (seed, dataset, corruption, severity, index).
+    Each sample has its own stream, so any of them can be regenerated in isolation, e.g.
+    `CORRUPTIONS_DS[dataset_name][corruption].apply(img, severity, rng=sample_rng(...))`.
+
+    :param random_seed: Base seed of the `DatasetManager`.
+    :param dataset_name: Name of the dataset.
+    :param corruption: Name of the corruption.
+    :param severity: Severity index.
+    :param index: Index of the image in the test set.
+    """
+    return image_rng(derive_seed(random_seed, dataset_name, corruption, severity), index)
+
+
+def _corrupt_unit(unit):
+    """
+    Corrupt one work unit, i.e. the images [start,stop) with a given corruption and severity.
+    Every image is corrupted with its own generator (see `sample_rng`), so the output does not 
+    depend on which process runs the unit, on the order of execution nor on the chunking.
+
+    :param unit: Tuple (corruption, severity, start, stop).
+    """
+    corruption, severity, start, stop = unit
+    dataset_name = WORKER_STATE['dataset_name']
+    corruptor = WORKER_STATE['corruptions'][corruption]
+
+    rngs = [sample_rng(WORKER_STATE['random_seed'], dataset_name, corruption, severity, index) for index in range(start, stop)]
+
+    imgs = np.asarray(WORKER_STATE['imgs'][start:stop])
+
+    # The defined corruptions support RGB images
+    if imgs.ndim == 3:
+        imgs = np.repeat(imgs[..., None], 3, axis=-1)
+
+    dataset_c = corruptor.apply_batch(imgs, severity, rng=rngs)
+
+    # Convert to greyscale, if required
+    if not DATASET_RGB[dataset_name]:
+        dataset_c = to_grayscale(dataset_c)
+
+    assert np.min(dataset_c) >= 0 or np.max(dataset_c) <= 255, f"(min,max) = {(np.min(dataset_c),np.max(dataset_c))}"
+    assert dataset_c.dtype == np.uint8, f"{dataset_c.dtype}"
+
+    return dataset_c
+
+
+def _library_versions(libraries):
+    """
+    Versions of the libraries affecting the generated images, recorded in the run manifest.
+
+    :param libraries: Names of the libraries used by the corruption (see `BaseCorruption.get_libraries`).
+    """
+    versions = {'medmnistc': __version__}
+    for name in libraries:
+        try:
+            versions[name] = getattr(importlib.import_module(name), '__version__', 'unknown')
+        except ImportError:
+            versions[name] = None
+    return versions
+
+
 class DatasetManager:
     def __init__(self, 
                  medmnist_path: str, 
                  output_path: str,
-                 random_seed : int = 0):
+                 random_seed : int = 0,
+                 num_workers : int = 0,
+                 chunk_size : int = 256,
+                 memory_budget : int = None,
+                 resume : bool = True,
+                 storage_format : str = 'npz',
+                 shard_index : int = None,
+                 num_shards : int = 1):
         """
         Class used to create the corrupted test sets.
         Speficially, it will create one `npz` file for each designed dataset-corruption.
@@ -20,7 +102,36 @@ class DatasetManager:
                             https://medmnist.com/
         :param output_path: Path to the output folder of the `medmnistc` dataset.
                         Path convention: {output_folder} / {dataset} / {corruption}.npz
-        :param random_seed: Control stochastic process and ensure reproducibility.                  
+        :param random_seed: Control stochastic process and ensure reproducibility. Each corrupted sample
+                            is drawn from its own generator, keyed by (seed, dataset, corruption, severity, index)
+                            (see `sample_rng`), so it can be regenerated in isolation.
+        :param num_workers: Number of worker processes used to corrupt the images.
+                            If 0, everything runs in the main process.
+        :param chunk_size: Number of images of each work unit (corruption, severity, chunk).
+                           The outputs are byte-identical for any `num_workers` and `chunk_size`.
+        :param memory_budget: If set, enable the streaming mode, with an approximate peak memory 
+                              (in bytes) that does not depend on the size of the dataset.
+                              The clean images are decompressed in blocks into a scratch `.npy` file
+                              and memory-mapped, while the corrupted chunks are written directly 
+                              into a preallocated on-disk array, later compressed into the `npz` file. 
+                              The budget bounds the number of work units in flight, and the 
+                              outputs are identical to the ones of the in-memory mode.
+        :param resume: If True, skip the corruptions whose output is up-to-date according to the 
+                       run manifest ({output_path} / manifest.json). The manifest records, for each
+                       dataset-corruption, the corruption parameters, the seed, the library versions
+                       and the checksum of the output. Missing or stale outputs are regenerated.
+        :param storage_format: Format of the corrupted test sets: {'npz', 'npy'}.
+                               - `npz`: compressed, {output_folder} / {dataset} / {corruption}.npz
+                               - `npy`: raw and memory-mappable, {output_folder} / {dataset} / {corruption}.npy
+                                        with shape (5, N, H, W[, C]), i.e. one slice per severity.
+                                        Labels are stored once in {output_folder} / {dataset} / test_labels.npy
+                               Both formats are supported by `CorruptedMedMNIST`.
+        :param shard_index: Index of the current node, in [0, num_shards), for multi-node generation.
+                            Each node corrupts a disjoint (chunk-aligned) slice of the images, stored as
+                            {output_folder} / {dataset} / shards / {corruption}.shard{index}of{num_shards}.npy
+                            Once all the nodes are done, `merge_dataset` assembles the standard layout,
+                            identical to the one of a single-node run with the same seed.
+        :param num_shards: Number of nodes sharing the generation. The merging node only needs `num_shards`.
         """
         self.medmnist_path = medmnist_path
         self.output_path = output_path
@@ -33,7 +144,21 @@ class DatasetManager:
         
         self.random_seed = random_seed
 
-        
+        assert num_workers >= 0, f"`num_workers` must be non-negative, got {num_workers}"
+        assert chunk_size > 0, f"`chunk_size` must be positive, got {chunk_size}"
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.resume = resume
+
+        assert storage_format in ['npz', 'npy'], f"Unknown `storage_format` {storage_format}. Please choose one among : ['npz', 'npy']"
+        self.storage_format = storage_format
+        self.manifest_path = os.path.join(self.output_path, 'manifest.json')
+
+        assert num_shards >= 1, f"`num_shards` must be positive, got {num_shards}"
+        assert shard_index is None or 0 <= shard_index < num_shards, f"`shard_index` must be in [0, {num_shards}), got {shard_index}"
+        self.shard_index = shard_index
+        self.num_shards = num_shards
 
 
     def create_dataset(self, dataset_name: str):
@@ -63,72 +188,421 @@ class DatasetManager:
     def create_single_dataset(self, dataset_name: str):
         """
         Generate one corrupted version for the required dataset.
-        Note that we store one .npz file for each designed corruptions.
+        Note that we store one .npz (or .npy) file for each designed corruptions.
+        In the sharded mode, only the slice of the current shard is generated.
 
         :param dataset_name: Name of the dataset to corrupt.
         """
         print(f"=========== {dataset_name} ===========")
 
-        rng = seed_everything(self.random_seed)
+        sharded = self.num_shards > 1
+        assert not sharded or self.shard_index is not None, "Please set `shard_index` to generate a shard."
 
         # Get the designed corruptions
         corruptions = CORRUPTIONS_DS[dataset_name]
 
-        # Get MedMNIST's dataset class
-        #   It required the pre-download of the 224 datasets
-        info = INFO[dataset_name]
-        DatasetClass = getattr(__import__('medmnist', fromlist=[info['python_class']]), info['python_class'])
-
-        dataset = DatasetClass( split = "test", 
-                                as_rgb = True,
-                                download = False, 
-                                transform = None, 
-                                size = 224,
-                                root = self.medmnist_path)
-    
         dataset_path = os.path.join(self.output_path,dataset_name)
         os.makedirs(dataset_path, exist_ok=True)
 
+        # Skip the corruptions that are up-to-date with the run manifest (or with the shard manifest)
+        manifest = self.load_manifest()
+        shard_manifest = self.load_manifest(self._shard_manifest_path(self.shard_index)) if sharded else {}
+        entries = {corruption : self._manifest_entry(dataset_name, corruption, corruptor) for (corruption, corruptor) in corruptions.items()}
+        pending = []
+
+        for corruption, entry in entries.items():
+            key = f'{dataset_name}/{corruption}'
+            if self.resume and self._is_up_to_date(manifest.get(key), entry):
+                print(f'Skipping {corruption} (up-to-date)')
+            elif sharded and self.resume and self._is_up_to_date(shard_manifest.get(key), self._shard_entry(entry, corruption, self.shard_index)):
+                print(f'Skipping {corruption} (shard up-to-date)')
+            else:
+                pending.append(corruption)
+
+        # The `npy` format stores the labels once per dataset (written by the merge step, if sharded)
+        labels_pending = not sharded and self._labels_pending(dataset_name, manifest)
+
+        if len(pending) == 0 and not labels_pending:
+            return
+
+        if self.memory_budget is None:
+
+            # Get MedMNIST's dataset class
+            #   It required the pre-download of the 224 datasets
+            info = INFO[dataset_name]
+            DatasetClass = getattr(__import__('medmnist', fromlist=[info['python_class']]), info['python_class'])
+
+            dataset = DatasetClass( split = "test", 
+                                    as_rgb = True,
+                                    download = False, 
+                                    transform = None, 
+                                    size = 224,
+                                    root = self.medmnist_path)
+            
+            imgs, labels = dataset.imgs, dataset.labels
+
+        else:
+
+            # Decompress the clean images in blocks and memory-map them, 
+            #   rather than loading the whole split through MedMNIST's dataset class
+            imgs, labels = self._load_clean_split(dataset_name, dataset_path)
+
+        if labels_pending:
+            self._save_labels(dataset_name, labels)
+
+        # Work units: by design, we have 5 intensity levels, and each level is split into chunks
+        num_images = len(imgs)
+        chunks = self._get_chunks(num_images)
+        image_shape = tuple(imgs.shape[1:3]) + ((3,) if DATASET_RGB[dataset_name] else ())
+
+        if sharded:
+            chunks = self._get_shard_chunks(chunks, self.shard_index)
+            
+            # Nothing to do for this shard (more shards than chunks)
+            if len(chunks) == 0:
+                return
+
+        # Number of work units in flight
+        window = 2 * self.num_workers
+        if self.memory_budget is not None:
+            unit_memory = self.chunk_size * int(np.prod(imgs.shape[1:3])) * 3 * _IMAGE_MEMORY_FACTOR
+            assert unit_memory <= self.memory_budget, f"A work unit needs ~{unit_memory} bytes, above the `memory_budget`. Please reduce the `chunk_size`."
+            window = max(1, min(window, self.memory_budget // unit_memory))
+
+        # In the streaming mode, workers memory-map the scratch file rather than receiving the images
+        worker_imgs = imgs if self.memory_budget is None else imgs.filename
+        worker_state = {'dataset_name': dataset_name, 'imgs': worker_imgs, 'corruptions': corruptions, 'random_seed': self.random_seed}
+
         # Create the corrupted datasets
-        # NOTE: This could be computationally heavy (RAM-wise) for large datasets (e.g. TissueMNIST),
-        #       as it multiply 5 times the test set.
-        dataset_c, labels = [], []
+        # NOTE: In the default mode, this could be computationally heavy (RAM-wise) for large datasets 
+        #       (e.g. TissueMNIST), as it multiply 5 times the test set. Use `memory_budget` for those.
+        try:
+            with worker_pool(self.num_workers, worker_state) as pool:
+                for corruption in pending:
+
+                    print(f'Starting {corruption}...')
+
+                    units = [(corruption, severity, start, stop) for severity in range(0,5) for (start, stop) in chunks]
+
+                    # Units are returned in order, so the output does not depend on `num_workers`
+                    results = tqdm(imap_bounded(pool, _corrupt_unit, units, window), total=len(units), desc=corruption)
+
+                    if sharded:
+                        filepath = self._shard_path(dataset_name, corruption, self.shard_index)
+                        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                        shape = (5, chunks[-1][1] - chunks[0][0]) + image_shape
+                        self._save_units(filepath, results, units, shape, 'npy', offset=chunks[0][0])
+
+                        entry = self._shard_entry(entries[corruption], corruption, self.shard_index)
+                        entry['sha256'] = file_checksum(filepath)
+                        self._update_manifest(f'{dataset_name}/{corruption}', entry, self._shard_manifest_path(self.shard_index))
+
+                    else:
+                        filepath = os.path.join(dataset_path,f'{corruption}.{self.storage_format}')
+                        shape = (5, num_images) + image_shape
+                        self._save_units(filepath, results, units, shape, self.storage_format, labels=np.concatenate([labels] * 5))
+
+                        entries[corruption]['sha256'] = file_checksum(filepath)
+                        self._update_manifest(f'{dataset_name}/{corruption}', entries[corruption])
+
+        finally:
+            if self.memory_budget is not None:
+                scratch_path = imgs.filename
+                del imgs
+                if os.path.exists(scratch_path):
+                    os.remove(scratch_path)
+
+
+    def merge_dataset(self, dataset_name: str):
+        """
+        Assemble the shards generated by `num_shards` nodes into the standard layout.
+        It requires all the shards to be completed, and it removes them once merged.
+
+        :param dataset_name: Name of the dataset to merge. Options: {'all', <dataset>}, as in `create_dataset`.
+        """
+        if dataset_name == 'all':
+            for ds in self.supported_datasets:
+                self.merge_single_dataset(dataset_name=ds)
+        else:
+            dataset_name = dataset_name.lower()
+            assert dataset_name in self.supported_datasets, f"Dataset not found. Please choose one among : {self.supported_datasets}"
+            self.merge_single_dataset(dataset_name=dataset_name)
+
+
+    def merge_single_dataset(self, dataset_name: str):
+        """
+        Merge the shards of one dataset. The shards are memory-mapped and copied into 
+        the final on-disk array, so the memory footprint does not depend on the dataset size.
+
+        :param dataset_name: Name of the dataset to merge.
+        """
+        print(f"=========== {dataset_name} (merge) ===========")
+
+        corruptions = CORRUPTIONS_DS[dataset_name]
+        dataset_path = os.path.join(self.output_path,dataset_name)
+        manifest = self.load_manifest()
+        shard_manifests = [self.load_manifest(self._shard_manifest_path(idx)) for idx in range(self.num_shards)]
+
+        # Labels are read from the clean split: np.load only decompresses the requested member
+        with np.load(os.path.join(self.medmnist_path, f'{dataset_name}_224.npz')) as npz_file:
+            labels = npz_file['test_labels']
+
+        if self._labels_pending(dataset_name, manifest):
+            self._save_labels(dataset_name, labels)
+
+        num_images = len(labels)
+
+        for (corruption, corruptor) in corruptions.items():
+
+            entry = self._manifest_entry(dataset_name, corruption, corruptor)
+            key = f'{dataset_name}/{corruption}'
+
+            if self.resume and self._is_up_to_date(manifest.get(key), entry):
+                print(f'Skipping {corruption} (up-to-date)')
+                continue
+
+            # The boundaries of the shards follow the `chunk_size` recorded by the nodes, not the one of the merge
+            chunk_sizes = {shard_manifests[idx][key].get('chunk_size') for idx in range(self.num_shards) if key in shard_manifests[idx]}
+            if len(chunk_sizes) > 1:
+                raise RuntimeError(f"The shards of {key} were generated with different `chunk_size` ({sorted(map(str, chunk_sizes))}). "
+                                   "Please re-run them with the same `chunk_size`.")
+            chunk_size = chunk_sizes.pop() if chunk_sizes else None
+            chunks = self._get_chunks(num_images, chunk_size)
+
+            # Collect the (non-empty) shards, checking that all of them are completed
+            shards, units = [], []
+            for idx in range(self.num_shards):
+                shard_chunks = self._get_shard_chunks(chunks, idx)
+                if len(shard_chunks) == 0:
+                    continue
+                
+                if not self._is_up_to_date(shard_manifests[idx].get(key), self._shard_entry(entry, corruption, idx, chunk_size)):
+                    raise RuntimeError(f"Shard {idx} of {key} is missing or stale. Please (re-)run it with `shard_index={idx}`.")
 
-        for (corruption,corruptor) in corruptions.items():
+                shard = np.load(self._shard_path(dataset_name, corruption, idx), mmap_mode='r')
+                start, stop = shard_chunks[0][0], shard_chunks[-1][1]
+                shards += [shard[severity] for severity in range(0,5)]
+                units += [(corruption, severity, start, stop) for severity in range(0,5)]
 
-            print(f'Starting {corruption}...')
+            print(f'Merging {corruption}...')
 
-            # Load the corrupted images and relative labels into lists
-            dataset_c, labels = [], []
+            filepath = os.path.join(dataset_path,f'{corruption}.{self.storage_format}')
+            shape = (5, num_images) + shards[0].shape[1:]
+            self._save_units(filepath, shards, units, shape, self.storage_format, labels=np.concatenate([labels] * 5), on_disk=True)
+            del shards
 
-            if corruption == "impulse_noise":
-                corruptor.rng = rng #skimage..
+            entry['sha256'] = file_checksum(filepath)
+            self._update_manifest(key, entry)
 
-            # By design, we have 5 intensity levels
-            for severity in range(0,5): 
+            for idx in range(self.num_shards):
+                shard_path = self._shard_path(dataset_name, corruption, idx)
+                if os.path.exists(shard_path):
+                    os.remove(shard_path)
 
-                # Define corruptor method
-                lam_corruption = lambda img : corruptor.apply(img, severity)
 
-                # Iterate over the MedMNIST dataset and apply corruptions
-                for img_idx in tqdm(range(len(dataset.imgs)), f'Severity {str(severity+1).zfill(2)}'):
+    def load_manifest(self, manifest_path: str = None):
+        """
+        Load the run manifest, i.e. a dictionary {dataset/corruption : entry}.
+
+        :param manifest_path: Path of the manifest. If None, the run manifest of `output_path`.
+        """
+        manifest_path = manifest_path or self.manifest_path
+        if not os.path.exists(manifest_path):
+            return {}
+        with open(manifest_path) as f:
+            return json.load(f)
+
+
+    def _update_manifest(self, key: str, entry: dict, manifest_path: str = None):
+        """
+        Add (or replace) one entry of the run manifest. The manifest is re-read before the update,
+        and atomically replaced, so that it stays valid if the run is interrupted.
+
+        :param key: Key of the entry, i.e. {dataset}/{corruption}.
+        :param entry: Manifest entry, including the checksum of the output.
+        :param manifest_path: Path of the manifest. If None, the run manifest of `output_path`.
+        """
+        manifest_path = manifest_path or self.manifest_path
+        manifest = self.load_manifest(manifest_path)
+        manifest[key] = entry
+
+        save_json(manifest_path, manifest, indent=4, sort_keys=True)
+
+
+    def _manifest_entry(self, dataset_name: str, corruption: str, corruptor):
+        """
+        Describe everything that determines the output of a dataset-corruption (without checksum).
+
+        :param dataset_name: Name of the dataset to corrupt.
+        :param corruption: Name of the corruption.
+        :param corruptor: Corruption object.
+        """
+        entry = {
+            'file' : f'{dataset_name}/{corruption}.{self.storage_format}',
+            'corruption' : corruptor.get_config(),
+            'seed' : self.random_seed,
+            'seeding' : _SEEDING,
+            'versions' : _library_versions(corruptor.get_libraries())
+        }
+        # Normalize it as it would be read back from the json file (e.g. tuples -> lists)
+        return json.loads(json.dumps(entry))
+
+
+    def _is_up_to_date(self, recorded: dict, entry: dict):
+        """
+        Check whether a recorded manifest entry matches the current one and its output is intact.
 
-                    img, label = dataset.imgs[img_idx], dataset.labels[img_idx]
+        :param recorded: Entry stored in the manifest (None if missing).
+        :param entry: Entry of the current run (without checksum).
+        """
+        if recorded is None or {k : v for (k, v) in recorded.items() if k != 'sha256'} != entry:
+            return False
+        
+        filepath = os.path.join(self.output_path, entry['file'])
+        return os.path.exists(filepath) and file_checksum(filepath) == recorded.get('sha256')
+
+
+    def _labels_pending(self, dataset_name: str, manifest: dict):
+        """
+        Whether the labels file of the `npy` storage format has to be (re-)generated.
+
+        :param dataset_name: Name of the dataset to corrupt.
+        :param manifest: Run manifest.
+        """
+        labels_entry = {'file' : f'{dataset_name}/test_labels.npy'}
+        return self.storage_format == 'npy' and not (self.resume and self._is_up_to_date(manifest.get(f'{dataset_name}/test_labels'), labels_entry))
+
+
+    def _save_labels(self, dataset_name: str, labels):
+        """
+        Store the labels once per dataset (`npy` storage format) and record them in the manifest.
+
+        :param dataset_name: Name of the dataset to corrupt.
+        :param labels: Clean test labels.
+        """
+        labels_entry = {'file' : f'{dataset_name}/test_labels.npy'}
+        filepath = os.path.join(self.output_path, labels_entry['file'])
+        save_npy(filepath, labels)
+        labels_entry['sha256'] = file_checksum(filepath)
+        self._update_manifest(f'{dataset_name}/test_labels', labels_entry)
+
+
+    def _get_chunks(self, num_images: int, chunk_size: int = None):
+        """
+        Split the image indices into chunks [start, stop) of `chunk_size` images.
+
+        :param num_images: Number of clean images.
+        :param chunk_size: Number of images per chunk. If None, the `chunk_size` of the manager.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        return [(start, min(start + chunk_size, num_images)) for start in range(0, num_images, chunk_size)]
+
+
+    def _get_shard_chunks(self, chunks: list, shard_index: int):
+        """
+        Contiguous subset of chunks assigned to one shard (possibly empty).
+
+        :param chunks: All the chunks of the dataset.
+        :param shard_index: Index of the shard.
+        """
+        return chunks[len(chunks) * shard_index // self.num_shards : len(chunks) * (shard_index + 1) // self.num_shards]
+
+
+    def _shard_path(self, dataset_name: str, corruption: str, shard_index: int):
+        """
+        Path of the partial output of one shard.
+        """
+        return os.path.join(self.output_path, dataset_name, 'shards', f'{corruption}.shard{shard_index}of{self.num_shards}.npy')
+
+
+    def _shard_manifest_path(self, shard_index: int):
+        """
+        Path of the manifest of one shard. Each node only writes its own manifest.
+        """
+        return os.path.join(self.output_path, f'manifest.shard{shard_index}of{self.num_shards}.json')
+
+
+    def _shard_entry(self, entry: dict, corruption: str, shard_index: int, chunk_size: int = None):
+        """
+        Manifest entry of the partial output of one shard. It records the `chunk_size` of the node,
+        which defines the boundaries of the shards.
+
+        :param chunk_size: Chunk size of the shard. If None, the `chunk_size` of the manager.
+        """
+        dataset_name = entry['file'].split('/')[0]
+        return dict(entry, file=f'{dataset_name}/shards/{corruption}.shard{shard_index}of{self.num_shards}.npy', 
+                    shard=[shard_index, self.num_shards], chunk_size=chunk_size or self.chunk_size)
+
+
+    def _load_clean_split(self, dataset_name: str, dataset_path: str):
+        """
+        Decompress the clean test images into a scratch `.npy` file and memory-map it.
+        The file follows MedMNIST's convention: {medmnist_path} / {dataset}_224.npz
+
+        :param dataset_name: Name of the dataset to corrupt.
+        :param dataset_path: Output folder of the current dataset, hosting the scratch file.
+        """
+        npz_path = os.path.join(self.medmnist_path, f'{dataset_name}_224.npz')
+        if not os.path.exists(npz_path):
+            raise RuntimeError(f"Dataset not found at {npz_path}. Please pre-download the 224 version.")
+
+        # Private to the shard and to the process, as the output folder may be shared by several nodes
+        shard = f'.shard{self.shard_index}of{self.num_shards}' if self.num_shards > 1 else ''
+        scratch_path = os.path.join(dataset_path, f'.clean_test_images{shard}.{os.getpid()}.npy')
+        extract_npz_member(npz_path, 'test_images', scratch_path)
+
+        with np.load(npz_path) as npz_file:
+            labels = npz_file['test_labels']
+
+        return np.load(scratch_path, mmap_mode='r'), labels
+
+
+    def _save_units(self, filepath, results, units, shape, storage_format, labels=None, offset=0, on_disk=None):
+        """
+        Write the corrupted chunks into an array of shape (5, N, H, W[, C]) and store it into `filepath`.
+        If `on_disk`, the array is preallocated on disk: in the `npz` format,
+        it is then compressed into `filepath`, while in the `npy` format it is directly (and atomically) 
+        moved to `filepath`. The output of the other format at the same path, if any, is then removed.
+
+        :param filepath: Path of the output `.npz` or `.npy` file.
+        :param results: Corrupted chunks, in the same order as `units`.
+        :param units: Work units (corruption, severity, start, stop).
+        :param shape: Shape of the output array (5, N, H, W[, C]).
+        :param storage_format: Output format: {'npz', 'npy'}.
+        :param labels: Labels of the corrupted test set (required for the `npz` format).
+        :param offset: Index of the first image of the output (i.e. start of the shard).
+        :param on_disk: Whether to preallocate the array on disk. If None, only in the streaming mode.
+        """
+        if on_disk is None:
+            on_disk = self.memory_budget is not None
 
-                    # The defined corruptions support RGB images
-                    img = Image.fromarray(img).convert('RGB')
-                    corrupted_img = lam_corruption(img)
+        if not on_disk:
+            dataset_c = np.concatenate(list(results)).reshape(shape)
+            if storage_format == 'npz':
+                save_npz(filepath, test_images=dataset_c.reshape((-1,) + shape[2:]), test_labels=labels)
+            else:
+                save_npy(filepath, dataset_c)
 
-                    # Convert to greyscale, if required
-                    if not DATASET_RGB[dataset_name]:
-                        corrupted_img = Image.fromarray(corrupted_img).convert('L')
+        else:
+            chunks = (((severity, slice(start - offset, stop - offset)), chunk) for (_, severity, start, stop), chunk in zip(units, results))
 
-                    np_corrupted = np.array(corrupted_img)
-                    assert np.min(np_corrupted) >= 0 or np.max(np_corrupted) <= 255, f"(min,max) = {(np.min(np_corrupted),np.max(np_corrupted))}"
-                    assert np_corrupted.dtype == np.uint8, f"{np_corrupted.dtype}"
+            if storage_format == 'npy':
+                save_npy_chunks(filepath, shape, chunks)
 
-                    dataset_c.append(np_corrupted)
-                    labels.append(label)
+            else:
+                # Assembled on disk, then compressed into `filepath`
+                scratch_path = f'{filepath}.{os.getpid()}.images.tmp'
+                try:
+                    save_npy_chunks(scratch_path, shape, chunks)
+                    dataset_c = np.load(scratch_path, mmap_mode='r')
+                    save_npz(filepath, test_images=dataset_c.reshape((-1,) + shape[2:]), test_labels=labels)
+                    del dataset_c
+                finally:
+                    if os.path.exists(scratch_path):
+                        os.remove(scratch_path)
 
-            filepath = os.path.join(dataset_path,f'{corruption}.npz')
-            np.savez_compressed(filepath, test_images=dataset_c, test_labels=labels)
\ No newline at end of file
+        # The output of a previous run in the other format would be served by the loaders (see `load_corrupted_test_set`)
+        other_format = 'npz' if storage_format == 'npy' else 'npy'
+        other_path = f'{os.path.splitext(filepath)[0]}.{other_format}'
+        if os.path.exists(other_path):
+            os.remove(other_path)
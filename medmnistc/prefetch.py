@@ -0,0 +1,172 @@
+from medmnistc.corruptions.base import image_rng
+from medmnistc.utils.utils import derive_seed
+from torch.utils.data import IterableDataset, get_worker_info
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import collections
+import threading
+import time
+
+
+class PrefetchAugmentedDataset(IterableDataset):
+    def __init__(self,
+                 dataset,
+                 augment,
+                 transform = None,
+                 num_threads : int = 4,
+                 queue_size : int = 64,
+                 shuffle : bool = True,
+                 random_seed : int = None):
+        """
+        Asynchronous version of a training dataset augmented with `AugMedMNISTC`: a pool of threads loads,
+        augments and transforms the samples ahead of the consumer, into a bounded queue. The corruptions
+        spend most of their time in OpenCV, PIL and NumPy kernels, which release the GIL, so the threads
+        overlap without forking DataLoader workers (e.g. with `num_workers=0` on memory-constrained nodes).
+        With `num_workers > 0`, each worker iterates over its own slice of the samples.
+
+        Each sample is augmented with its own generator, keyed by (seed, epoch, index), so the outputs do not
+        depend on the number of threads nor on their scheduling, and samples are yielded in order.
+
+        :param dataset: Training dataset returning (image, target), without transform (e.g. a MedMNIST
+                        dataset with `transform=None`).
+        :param augment: Augmentation called as `augment(img, rng=rng)`, e.g. `AugMedMNISTC`.
+        :param transform: Transform applied after the augmentation (e.g. `ToTensor` and `Normalize`).
+        :param num_threads: Number of threads augmenting the samples.
+        :param queue_size: Maximum number of samples in flight (being augmented or waiting to be consumed).
+        :param shuffle: Whether to shuffle the samples at each epoch (see `set_epoch`).
+        :param random_seed: Seed of the shuffling and of the augmentations. If None, a seed is drawn at each epoch
+                            from the global numpy random state (so `seed_everything` keeps it reproducible),
+                            or in DataLoader workers, from the base seed of the DataLoader.
+        """
+        super(PrefetchAugmentedDataset, self).__init__()
+        assert num_threads >= 1, f"`num_threads` must be positive, got {num_threads}"
+        assert queue_size >= 1, f"`queue_size` must be positive, got {queue_size}"
+
+        self.dataset = dataset
+        self.augment = augment
+        self.transform = transform
+        self.num_threads = num_threads
+        self.queue_size = queue_size
+        self.shuffle = shuffle
+        self.random_seed = random_seed
+        self.epoch = 0
+
+        self._lock = threading.Lock()
+        self.reset_metrics()
+
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+    def __getstate__(self):
+        # The lock cannot be pickled (e.g. to spawn DataLoader workers)
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def set_epoch(self, epoch: int):
+        """
+        Set the epoch, which keys the shuffling and the augmentations (as `DistributedSampler.set_epoch`).
+        """
+        self.epoch = epoch
+
+
+    def reset_metrics(self):
+        with self._lock:
+            self._metrics = {'samples': 0, 'starved': 0, 'wait_time': 0., 'ready': 0, 'busy_time': 0.}
+
+
+    def metrics(self):
+        """
+        Starvation metrics of the current process, since the last `reset_metrics`:
+            - `samples`: number of samples consumed.
+            - `starved`: number of samples the consumer had to wait for (the queue was starved).
+            - `starved_ratio`: proportion of starved samples. Close to 0, the augmentation keeps up.
+            - `wait_time`: total time (s) spent by the consumer waiting for samples.
+            - `mean_ready`: average number of samples ready in the queue when one is consumed.
+            - `busy_time`: total time (s) spent by the threads loading, augmenting and transforming samples.
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+        samples = max(metrics['samples'], 1)
+        metrics['starved_ratio'] = metrics['starved'] / samples
+        metrics['mean_ready'] = metrics.pop('ready') / samples
+        return metrics
+
+
+    def _indices(self, seed, worker_info):
+        indices = np.arange(len(self.dataset))
+        if self.shuffle:
+            indices = np.random.default_rng(derive_seed(seed, 'shuffle', self.epoch)).permutation(indices)
+
+        # Each DataLoader worker iterates over its own slice of the samples
+        if worker_info is not None:
+            indices = indices[worker_info.id::worker_info.num_workers]
+        return indices
+
+
+    def _load(self, index, key):
+        start = time.perf_counter()
+        img, target = self.dataset[index]
+        img = self.augment(img, rng=image_rng(key, index))
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        with self._lock:
+            self._metrics['busy_time'] += time.perf_counter() - start
+        return img, target
+
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if self.random_seed is not None:
+            seed = self.random_seed
+        elif worker_info is not None:
+            # The base seed of the DataLoader, drawn at each epoch and shared by its workers
+            seed = worker_info.seed - worker_info.id
+        else:
+            seed = int(np.random.randint(2**31))
+        key = derive_seed(seed, 'augment', self.epoch)
+        indices = iter(self._indices(seed, worker_info).tolist())
+
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            pending = collections.deque()
+            try:
+                for index in indices:
+                    pending.append(executor.submit(self._load, index, key))
+                    if len(pending) >= self.queue_size:
+                        yield self._next(pending)
+                while pending:
+                    yield self._next(pending)
+            finally:
+                # Stopped early (e.g. `break`): drop the samples in flight
+                for future in pending:
+                    future.cancel()
+
+
+    def _next(self, pending):
+        """
+        Pop the next sample (in order), recording whether the consumer had to wait for it.
+        """
+        future = pending.popleft()
+        ready = sum(f.done() for f in pending) + future.done()
+        starved = not future.done()
+
+        start = time.perf_counter()
+        sample = future.result()
+        wait_time = time.perf_counter() - start if starved else 0.
+
+        with self._lock:
+            self._metrics['samples'] += 1
+            self._metrics['starved'] += starved
+            self._metrics['wait_time'] += wait_time
+            self._metrics['ready'] += ready
+        return sample
@@ -0,0 +1,75 @@
+from medmnistc.corruptions.base import set_num_threads
+from contextlib import contextmanager
+import multiprocessing
+import collections
+import numpy as np
+
+
+# State of the current (worker) process, populated by `init_worker`.
+WORKER_STATE = {}
+
+
+def init_worker(state: dict, num_threads: int = None):
+    """
+    Initialize the process that will run the work units (see `worker_pool`).
+
+    :param state: Dictionary stored into `WORKER_STATE`. If `state['imgs']` is a path
+                  to a raw `.npy` file, it is memory-mapped.
+    :param num_threads: If given, number of threads of the batch paths of the corruptions.
+    """
+    if num_threads is not None:
+        set_num_threads(num_threads)
+
+    state = dict(state)
+    if isinstance(state.get('imgs'), str):
+        state['imgs'] = np.load(state['imgs'], mmap_mode='r')
+
+    WORKER_STATE.update(state)
+
+
+@contextmanager
+def worker_pool(num_workers: int, state: dict):
+    """
+    Pool of `num_workers` processes, whose `WORKER_STATE` is initialized with `state` (see `init_worker`).
+    Each of them runs one thread, to avoid oversubscribing the cores. If `num_workers` is 0, it yields None
+    and the current process is initialized instead. The state is cleared on exit.
+
+    :param num_workers: Number of worker processes.
+    :param state: State of the workers, e.g. the images and the corruptions.
+    """
+    if num_workers > 0:
+        pool = multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(state, 1))
+    else:
+        pool = None
+        init_worker(state)
+
+    try:
+        yield pool
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        WORKER_STATE.clear()
+
+
+def imap_bounded(pool, func, iterable, window: int):
+    """
+    Ordered `imap` that keeps at most `window` submitted tasks (and results) in flight.
+
+    :param pool: Process pool. If None, `func` is mapped in the current process.
+    :param func: Function to apply.
+    :param iterable: Inputs of `func`.
+    :param window: Maximum number of pending tasks.
+    """
+    if pool is None:
+        yield from map(func, iterable)
+        return
+
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
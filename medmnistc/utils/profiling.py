@@ -0,0 +1,270 @@
+from multiprocessing import util
+import numpy as np
+import functools
+import threading
+import tracemalloc
+import bisect
+import json
+import glob
+import time
+import os
+
+
+# Environment variables propagating the profiling settings to the spawned worker processes
+PROFILE_DIR_ENV = 'MEDMNISTC_PROFILE_DIR'
+TRACE_MEMORY_ENV = 'MEDMNISTC_PROFILE_TRACE_MEMORY'
+
+# Upper edges (in seconds) of the latency histograms: 4 log-spaced bins per decade, from 1us to 10s.
+# The last bin collects the slower calls.
+LATENCY_BINS = [float(edge) for edge in 10 ** np.arange(-6, 1.01, 0.25)]
+
+# Process-wide profiling state. The statistics belong to the process `pid`: a forked worker inherits
+# the ones of its parent, which are discarded on its first record (see `_get_stats`).
+_STATE = {'enabled': False, 'trace_memory': False, 'output_dir': None, 'pid': None}
+_STATS = {}
+_LOCK = threading.Lock()
+
+# Stack of the names of the calls being profiled in the current thread, to which the sampled parameters are attributed
+_ACTIVE = threading.local()
+
+
+def enable(output_dir: str = None, trace_memory: bool = False):
+    """
+    Enable the profiling of the corruptions (`apply`, `apply_batch`, `apply_tensor`) and of `AugMedMNISTC`.
+    For each call name, it records the number of calls and of images, a latency histogram, the bytes of
+    the outputs and a summary of the parameters sampled with `uniform` (e.g. the intensities in augmentation
+    mode, pooled when a corruption samples several of them).
+
+    The settings are inherited by the worker processes (e.g. of a DataLoader), forked or spawned.
+    If `output_dir` is given, each process dumps its statistics to `output_dir/profile-{pid}.json`
+    when it exits, and `collect(output_dir)` aggregates them.
+
+    :param output_dir: Directory of the per-process reports, or None to only profile the current process.
+    :param trace_memory: If True, also record the peak memory allocated by each call with `tracemalloc`.
+                         It slows down the calls and, with threaded batches, the peaks are shared by the threads.
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        os.environ[PROFILE_DIR_ENV] = os.path.abspath(output_dir)
+    else:
+        os.environ.pop(PROFILE_DIR_ENV, None)
+    os.environ[TRACE_MEMORY_ENV] = '1' if trace_memory else '0'
+    _STATE.update(enabled=True, trace_memory=trace_memory, output_dir=output_dir)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """
+    Disable the profiling (the statistics recorded so far are kept, see `reset`).
+    """
+    os.environ.pop(PROFILE_DIR_ENV, None)
+    os.environ.pop(TRACE_MEMORY_ENV, None)
+    _STATE.update(enabled=False, trace_memory=False, output_dir=None)
+
+
+def is_enabled():
+    return _STATE['enabled']
+
+
+def reset():
+    """
+    Discard the statistics recorded by the current process.
+    """
+    with _LOCK:
+        _STATS.clear()
+
+
+def _get_stats():
+    """
+    Statistics of the current process. On the first record of a new (worker) process, the inherited statistics
+    are discarded and, if required, the dump of the report at exit is registered. `multiprocessing` runs the
+    finalizers when its processes exit, which `atexit` does not.
+    """
+    if _STATE['pid'] != os.getpid():
+        with _LOCK:
+            if _STATE['pid'] != os.getpid():
+                _STATS.clear()
+                _STATE['pid'] = os.getpid()
+                if _STATE['output_dir'] is not None:
+                    util.Finalize(None, dump, exitpriority=10)
+    return _STATS
+
+
+def _new_entry():
+    return {'calls': 0, 'images': 0, 'total_time': 0., 'min_time': float('inf'), 'max_time': 0.,
+            'histogram': [0] * (len(LATENCY_BINS) + 1), 'output_bytes': 0, 'peak_bytes': 0,
+            'params': {'count': 0, 'sum': 0., 'min': float('inf'), 'max': float('-inf')}}
+
+
+def _record(name, elapsed, num_images, output_bytes, peak_bytes, params):
+    stats = _get_stats()
+    with _LOCK:
+        entry = stats.get(name)
+        if entry is None:
+            entry = stats[name] = _new_entry()
+        entry['calls'] += 1
+        entry['images'] += num_images
+        entry['total_time'] += elapsed
+        entry['min_time'] = min(entry['min_time'], elapsed)
+        entry['max_time'] = max(entry['max_time'], elapsed)
+        entry['histogram'][bisect.bisect_left(LATENCY_BINS, elapsed)] += 1
+        entry['output_bytes'] += output_bytes
+        entry['peak_bytes'] = max(entry['peak_bytes'], peak_bytes)
+        for value in params:
+            entry['params']['count'] += 1
+            entry['params']['sum'] += value
+            entry['params']['min'] = min(entry['params']['min'], value)
+            entry['params']['max'] = max(entry['params']['max'], value)
+
+
+def record_param(value):
+    """
+    Attribute a sampled parameter to the innermost call being profiled in the current thread (no-op otherwise).
+    """
+    stack = getattr(_ACTIVE, 'stack', None)
+    if stack:
+        stack[-1][1].append(float(value))
+
+
+def call(name, func, *args, num_images=1, **kwargs):
+    """
+    Call `func(*args, **kwargs)` and, if the profiling is enabled, record it under `name` (see `enable`).
+    Nested calls with the same name (e.g. `super().apply`) are only recorded once.
+
+    :param name: Name of the call in the report, e.g. `Pixelate.apply_batch`.
+    :param num_images: Number of images processed by the call.
+    """
+    if not _STATE['enabled']:
+        return func(*args, **kwargs)
+    if not hasattr(_ACTIVE, 'stack'):
+        _ACTIVE.stack = []
+    stack = _ACTIVE.stack
+    if stack and stack[-1][0] == name:
+        return func(*args, **kwargs)
+
+    trace_memory = _STATE['trace_memory'] and tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    params = []
+    stack.append((name, params))
+    start = time.perf_counter()
+    try:
+        out = func(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+    peak_bytes = tracemalloc.get_traced_memory()[1] - start_memory if trace_memory else 0
+    _record(name, elapsed, num_images, int(getattr(out, 'nbytes', 0)), peak_bytes, params)
+    return out
+
+
+def profiled(method):
+    """
+    Decorator of the `apply*` methods of the corruptions, recorded as `{class name}.{method name}`.
+    When the profiling is disabled, the only overhead is a flag check.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not _STATE['enabled']:
+            return method(self, *args, **kwargs)
+        num_images = 1 if method.__name__ == 'apply' else len(args[0] if args else kwargs['imgs'])
+        return call(f'{type(self).__name__}.{method.__name__}', method, self, *args, num_images=num_images, **kwargs)
+
+    return wrapper
+
+
+def report():
+    """
+    JSON-serializable statistics of the current process, by call name, with the mean latency and parameter.
+    """
+    stats = _get_stats()
+    with _LOCK:
+        stats = json.loads(json.dumps(stats))
+    return _finalize_report({'pids': [os.getpid()], 'latency_bins': LATENCY_BINS, 'calls': stats})
+
+
+def _finalize_report(report):
+    for entry in report['calls'].values():
+        entry['mean_time'] = entry['total_time'] / entry['calls'] if entry['calls'] else 0.
+        params = entry['params']
+        params['mean'] = params['sum'] / params['count'] if params['count'] else None
+        for key in ['min', 'max']:
+            if params['count'] == 0:
+                params[key] = None
+        if entry['calls'] == 0:
+            entry['min_time'] = None
+    return report
+
+
+def dump(filepath: str = None):
+    """
+    Atomically write the report of the current process as JSON.
+
+    :param filepath: Output path, by default `{output_dir}/profile-{pid}.json` (see `enable`).
+    """
+    if filepath is None:
+        assert _STATE['output_dir'] is not None, "No output directory: set one in `enable` or pass a `filepath`."
+        filepath = os.path.join(_STATE['output_dir'], f'profile-{os.getpid()}.json')
+    tmp_path = f'{filepath}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(report(), f, indent=2)
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return filepath
+
+
+def merge(reports: list):
+    """
+    Aggregate the reports of several processes (see `report`) into a single one.
+    """
+    merged = {'pids': [], 'latency_bins': LATENCY_BINS, 'calls': {}}
+    for rep in reports:
+        assert rep['latency_bins'] == LATENCY_BINS, "Reports with different latency bins cannot be merged."
+        merged['pids'] += rep['pids']
+        for name, entry in rep['calls'].items():
+            total = merged['calls'].setdefault(name, _new_entry())
+            for key in ['calls', 'images', 'total_time', 'output_bytes']:
+                total[key] += entry[key]
+            if entry['calls']:
+                total['min_time'] = min(total['min_time'], entry['min_time'])
+            total['max_time'] = max(total['max_time'], entry['max_time'])
+            total['peak_bytes'] = max(total['peak_bytes'], entry['peak_bytes'])
+            total['histogram'] = [a + b for a, b in zip(total['histogram'], entry['histogram'])]
+            params = entry['params']
+            total['params']['count'] += params['count']
+            total['params']['sum'] += params['sum']
+            if params['count']:
+                total['params']['min'] = min(total['params']['min'], params['min'])
+                total['params']['max'] = max(total['params']['max'], params['max'])
+    return _finalize_report(merged)
+
+
+def collect(output_dir: str, filepath: str = None):
+    """
+    Aggregate the reports dumped in `output_dir` by the worker processes with the live statistics of
+    the current process (whose own dump, if any, is skipped).
+
+    :param output_dir: Directory of the reports (see `enable`).
+    :param filepath: If given, the aggregated report is also written there as JSON.
+    """
+    reports = [report()]
+    for path in sorted(glob.glob(os.path.join(output_dir, 'profile-*.json'))):
+        if os.path.basename(path) == f'profile-{os.getpid()}.json':
+            continue
+        with open(path) as f:
+            reports.append(json.load(f))
+    merged = merge(reports)
+    if filepath is not None:
+        with open(filepath, 'w') as f:
+            json.dump(merged, f, indent=2)
+    return merged
+
+
+# Spawned workers re-import the module: restore the settings of the parent
+if PROFILE_DIR_ENV in os.environ or TRACE_MEMORY_ENV in os.environ:
+    enable(os.environ.get(PROFILE_DIR_ENV), os.environ.get(TRACE_MEMORY_ENV) == '1')
@@ -0,0 +1,313 @@
+from contextlib import contextmanager
+import numpy as np
+import hashlib
+import zipfile
+import shutil
+import json
+import time
+import os
+
+try:
+    import fcntl
+except ImportError: # not available on Windows, see `file_lock`
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError: # only available on Windows, see `file_lock`
+    msvcrt = None
+
+
+# Fixed timestamp of the archive members, so that identical arrays always
+# produce byte-identical files (np.savez_compressed stamps the current time).
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Size of the blocks used to stream data from/to the disk.
+COPY_BUFFER_SIZE = 16 * 1024 ** 2
+
+
+def save_npz(filepath: str, **arrays):
+    """
+    Deterministic drop-in replacement of `np.savez_compressed`.
+    The resulting file can be read back with `np.load`.
+    Arrays are written in blocks of 16MB by numpy, so memory-mapped arrays are 
+    never fully loaded into RAM. The file is first written to a temporary path and 
+    then atomically moved to `filepath`, so an interrupted run never leaves partial outputs.
+
+    :param filepath: Path of the output `.npz` file.
+    :param arrays: Arrays to store, saved as `{name}.npy` members.
+    """
+    tmp_path = f'{filepath}.{os.getpid()}.tmp'
+    try:
+        with zipfile.ZipFile(tmp_path, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for name, array in arrays.items():
+                info = zipfile.ZipInfo(f'{name}.npy', date_time=ZIP_DATE_TIME)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with zf.open(info, mode='w', force_zip64=True) as fid:
+                    np.lib.format.write_array(fid, np.asanyarray(array), allow_pickle=False)
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_npy(filepath: str, array):
+    """
+    Atomically store an array as a raw (uncompressed) `.npy` file, which can be memory-mapped.
+
+    :param filepath: Path of the output `.npy` file.
+    :param array: Array to store.
+    """
+    tmp_path = f'{filepath}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_npy_chunks(filepath: str, shape: tuple, chunks, dtype=np.uint8):
+    """
+    Atomically store an array assembled chunk by chunk into a raw `.npy` file. The array is
+    preallocated on disk (memory-mapped) rather than in RAM, and moved to `filepath` once complete.
+
+    :param filepath: Path of the output `.npy` file.
+    :param shape: Shape of the array.
+    :param chunks: Iterable of (index, values), written as `array[index] = values`.
+    :param dtype: Data type of the array.
+    """
+    tmp_path = f'{filepath}.{os.getpid()}.tmp'
+    try:
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+        for index, values in chunks:
+            array[index] = values
+        array.flush()
+        del array
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_json(filepath: str, obj, **kwargs):
+    """
+    Atomically write `obj` as JSON, so that an interrupted run never leaves a partial file.
+
+    :param filepath: Path of the output `.json` file.
+    :param kwargs: Arguments of `json.dump`, e.g. `indent`.
+    """
+    tmp_path = f'{filepath}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f, **kwargs)
+        os.replace(tmp_path, filepath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_corrupted_test_set(root: str, dataset_name: str, corruption: str, mmap_mode: str = None, cache_dir: str = None):
+    """
+    Load the images and labels of one corrupted test set, in any of the supported storage formats:
+        - `npz`: {root} / {dataset} / {corruption}.npz, with `test_images` and `test_labels`.
+        - `npy`: {root} / {dataset} / {corruption}.npy, with shape (5, N, H, W[, C]), and 
+                 {root} / {dataset} / test_labels.npy, stored once per dataset. 
+                 The images are always memory-mapped (read-only if `mmap_mode` is None).
+    In both cases, images are returned with shape (5*N, H, W[, C]), ordered by severity,
+    and labels are repeated for the 5 severities.
+
+    :param root: Root path of the generated corrupted data.
+    :param dataset_name: Name of the reference medmnist dataset.
+    :param corruption: Name of the desired corruption.
+    :param mmap_mode: Memory mapping of the file: {None, ‘r+’, ‘r’, ‘w+’, ‘c’}.
+    :param cache_dir: If given, the members of a `npz` file are decompressed once into raw `.npy` files 
+                      under {cache_dir} / {dataset} / (see `cached_npz_members`), which are then memory-mapped 
+                      (read-only if `mmap_mode` is None) rather than loaded into RAM.
+    """
+    dataset_path = os.path.join(root, dataset_name)
+    npy_path = os.path.join(dataset_path, f'{corruption}.npy')
+
+    if os.path.exists(npy_path):
+        images = np.load(npy_path, mmap_mode=mmap_mode or 'r')
+        images = images.reshape((-1,) + images.shape[2:]) # view, no copy
+        labels = np.load(os.path.join(dataset_path, 'test_labels.npy'))
+        return images, np.concatenate([labels] * 5)
+
+    npz_path = os.path.join(dataset_path, f'{corruption}.npz')
+
+    if cache_dir is not None:
+        paths = cached_npz_members(npz_path, ['test_images', 'test_labels'], os.path.join(cache_dir, dataset_name))
+        return tuple(np.load(path, mmap_mode=mmap_mode or 'r') for path in paths)
+
+    npz_file = np.load(npz_path, mmap_mode=mmap_mode)
+    return npz_file['test_images'], npz_file['test_labels']
+
+
+@contextmanager
+def file_lock(lock_path: str, poll_interval: float = 0.1, timeout: float = None, stale_after: float = 600.):
+    """
+    Exclusive lock shared by all the processes of the machine (and of the nodes sharing a filesystem 
+    that supports it), held on `lock_path`. It relies on `fcntl.flock` (POSIX) or `msvcrt.locking` (Windows), 
+    both released by the OS if the holder dies. Without them, it falls back to the atomic creation of the 
+    lock file, which records the pid of its holder: a lock file older than `stale_after` seconds is 
+    considered left by a killed process, and broken.
+
+    :param lock_path: Path of the lock file.
+    :param poll_interval: Waiting time (s) between two attempts.
+    :param timeout: Maximum waiting time (s), after which a `TimeoutError` is raised. If None, wait indefinitely.
+    :param stale_after: Age (s) after which the lock file of the fallback is broken.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def wait():
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f"Could not acquire the lock {lock_path} within {timeout}s.")
+        time.sleep(poll_interval)
+
+    if fcntl is not None:
+        with open(lock_path, 'a') as f:
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX if deadline is None else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    wait()
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return
+
+    if msvcrt is not None:
+        with open(lock_path, 'a+') as f:
+            while True:
+                try:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    wait()
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        return
+
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.path.getmtime(lock_path) > stale_after:
+                with open(lock_path) as f:
+                    holder = f.read() or 'unknown'
+                print(f'Breaking the stale lock {lock_path} (held by process {holder})')
+                os.remove(lock_path)
+                continue
+        except FileNotFoundError: # released in the meantime
+            continue
+        wait()
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+def cached_npz_members(npz_path: str, names: list, cache_path: str):
+    """
+    Decompress (once) some arrays of a `.npz` file into raw `.npy` files, which can be memory-mapped.
+    The cache lives in `cache_path`, as {npz name}.{member}.npy, and is described by {npz name}.json,
+    written last, which records the size and modification time of the source: a cache whose source changed 
+    is rebuilt. The members are extracted atomically (see `extract_npz_member`), under a lock shared by the 
+    processes (see `file_lock`), so concurrent processes (e.g. DataLoader workers) decompress each file once,
+    while the later opens only check the description of the cache, without locking.
+
+    :param npz_path: Path of the `.npz` file.
+    :param names: Names of the arrays to extract (e.g. `test_images`).
+    :param cache_path: Folder of the cache.
+    :return: Paths of the `.npy` files, in the order of `names`.
+    """
+    os.makedirs(cache_path, exist_ok=True)
+    prefix = os.path.join(cache_path, os.path.splitext(os.path.basename(npz_path))[0])
+    paths = [f'{prefix}.{name}.npy' for name in names]
+    meta_path = f'{prefix}.json'
+
+    stat = os.stat(npz_path)
+    meta = {'source': os.path.abspath(npz_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'members': list(names)}
+
+    def is_valid():
+        if not os.path.exists(meta_path) or not all(os.path.exists(path) for path in paths):
+            return False
+        with open(meta_path) as f:
+            return json.load(f) == meta
+
+    if is_valid():
+        return paths
+
+    with file_lock(f'{prefix}.lock'):
+        # Another process may have built the cache while we were waiting for the lock
+        if not is_valid():
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            for name, path in zip(names, paths):
+                extract_npz_member(npz_path, name, path)
+
+            save_json(meta_path, meta)
+
+    return paths
+
+
+def extract_npz_member(npz_path: str, name: str, out_path: str):
+    """
+    Decompress one array of a (compressed) `.npz` file into a raw `.npy` file, 
+    which can then be memory-mapped via `np.load(out_path, mmap_mode='r')`.
+    The member is streamed in blocks of `COPY_BUFFER_SIZE` bytes, and the output 
+    is first written to a temporary file and then atomically moved to `out_path`.
+
+    :param npz_path: Path of the `.npz` file.
+    :param name: Name of the array to extract (e.g. `test_images`).
+    :param out_path: Path of the output `.npy` file.
+    """
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    try:
+        with zipfile.ZipFile(npz_path) as zf, zf.open(f'{name}.npy') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def file_checksum(filepath: str):
+    """
+    SHA-256 checksum of a file, computed in blocks of `COPY_BUFFER_SIZE` bytes.
+
+    :param filepath: Path of the file.
+    """
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def array_checksum(array):
+    """
+    SHA-256 checksum of the dtype, shape and content of an array, computed in blocks of about 
+    `COPY_BUFFER_SIZE` bytes, so memory-mapped arrays are never fully loaded into RAM.
+
+    :param array: Array of shape (N, ...).
+    """
+    array = np.asanyarray(array)
+    sha = hashlib.sha256(f'{array.dtype.str}{array.shape}'.encode())
+    rows = max(1, COPY_BUFFER_SIZE // max(1, array[0].nbytes)) if len(array) else 1
+    for start in range(0, len(array), rows):
+        sha.update(np.ascontiguousarray(array[start:start + rows]).data)
+    return sha.hexdigest()
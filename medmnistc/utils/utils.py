@@ -1,5 +1,6 @@
 import numpy as np
 import random
+import zlib
 import torch
 import os
 
@@ -12,5 +13,17 @@ def seed_everything(seed: int):
     torch.cuda.manual_seed(seed)
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
-    rng = np.random.default_rng(seed) # rng will be used on skimage.util.random_noise
-    return rng
\ No newline at end of file
+    rng = np.random.default_rng(seed)
+    return rng
+
+def derive_seed(seed: int, *key):
+    """
+    Derive a 32-bit seed from a base seed and a key (e.g. dataset, corruption, severity, index).
+    The same (seed, key) always yields the same value, independently of the process or of the
+    order in which the keys are requested.
+
+    :param seed: Base random seed.
+    :param key: Sequence of integers and/or strings identifying the stochastic unit.
+    """
+    entropy = [seed] + [zlib.crc32(k.encode()) if isinstance(k, str) else int(k) for k in key]
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
@@ -1,4 +1,5 @@
 from medmnistc.corruptions.registry import DATASET_RGB, CORRUPTIONS_DS
+from medmnistc.utils.storage import load_corrupted_test_set
 
 from skimage.util import montage as skimage_montage
 from PIL import Image
@@ -68,7 +69,7 @@ class Visualizer:
         num_images = len(clean_test_images)
 
         # Retrieve all corruption paths
-        corruptions_path = os.listdir(os.path.join(self.medmnistc_path,dataset_name))
+        corruptions_path = list(CORRUPTIONS_DS[dataset_name].keys())
         
         # Setup image grid
         num_rows, num_cols = len(corruptions_path), 6
@@ -86,7 +87,7 @@ class Visualizer:
         # Iterate over corruptions (ROWS)
         for corruption in CORRUPTIONS_DS[dataset_name].keys():
 
-            test_images = np.load(os.path.join(self.medmnistc_path,dataset_name,f'{corruption}.npz'))['test_images']
+            test_images, _ = load_corrupted_test_set(self.medmnistc_path, dataset_name, corruption)
 
             # Annotate the image in the first column
             corrutpion_name = corruption.split(".npz")[0].replace("_"," ")
@@ -146,7 +147,7 @@ class Visualizer:
         num_images = len(clean_test_images)
         
         # Retrieve all designed corruptions
-        corruptions_path = os.listdir(os.path.join(self.medmnistc_path,dataset_name))
+        corruptions_path = list(CORRUPTIONS_DS[dataset_name].keys())
         
         if not idx_image:
             idx_image = random.randint(0,num_images-1)
@@ -161,7 +162,7 @@ class Visualizer:
         # Iterate over corruptions
         for corruption in CORRUPTIONS_DS[dataset_name].keys():
 
-            test_images = np.load(os.path.join(self.medmnistc_path,dataset_name,f'{corruption}.npz'))['test_images']
+            test_images, _ = load_corrupted_test_set(self.medmnistc_path, dataset_name, corruption)
             corrutpion_name = corruption.split(".npz")[0].replace("_"," ")
             idx_corr = idx_image + (severity-1) * num_images
 
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+
+from medmnistc.corruptions.registry import CORRUPTIONS_DS
+from medmnistc.augmentation_bank import create_augmentation_bank, AugMedMNISTCBank, AugmentedDataset
+
+
+TRAIN_CORRUPTIONS = CORRUPTIONS_DS['breastmnist']
+
+
+class ArrayDataset:
+    # Minimal MedMNIST-like dataset, exposing its images
+    def __init__(self, imgs):
+        self.imgs = imgs
+
+    def __len__(self):
+        return len(self.imgs)
+
+    def __getitem__(self, index):
+        return self.imgs[index], 0
+
+
+@pytest.fixture
+def imgs():
+    return np.random.default_rng(0).integers(0, 256, (10, 28, 28), dtype=np.uint8)
+
+
+def _create(imgs, bank_path):
+    create_augmentation_bank(imgs, TRAIN_CORRUPTIONS, str(bank_path), num_variants=2, corruptions=['pixelate'], chunk_size=4)
+
+
+def test_resume_checks_images(imgs, tmp_path, capsys):
+    _create(imgs, tmp_path)
+    bank = np.load(tmp_path / 'pixelate.npy')
+
+    _create(imgs, tmp_path)
+    assert 'Skipping pixelate' in capsys.readouterr().out
+
+    # Other images of the same shape: the bank is regenerated
+    _create(imgs[::-1].copy(), tmp_path)
+    assert 'Skipping pixelate' not in capsys.readouterr().out
+    assert not np.array_equal(np.load(tmp_path / 'pixelate.npy'), bank)
+
+
+def test_dataset_mismatch(imgs, tmp_path):
+    _create(imgs, tmp_path)
+    augment = AugMedMNISTCBank(TRAIN_CORRUPTIONS, str(tmp_path))
+
+    AugmentedDataset(ArrayDataset(imgs), augment)
+
+    with pytest.raises(AssertionError, match='holds 10 images'):
+        AugmentedDataset(ArrayDataset(imgs[:8]), augment)
+
+    with pytest.raises(AssertionError, match='other images'):
+        AugmentedDataset(ArrayDataset(imgs[::-1]), augment)
+
+    AugmentedDataset(ArrayDataset(imgs[::-1]), augment, check_images=False)
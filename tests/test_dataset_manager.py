@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('medmnist')
+
+from medmnistc.corruptions import registry
+from medmnistc.dataset_manager import DatasetManager
+from medmnistc.utils.storage import load_corrupted_test_set
+
+
+DATASET = 'breastmnist'
+
+
+@pytest.fixture
+def clean_path(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    path = tmp_path / 'clean'
+    path.mkdir()
+    np.savez_compressed(path / f'{DATASET}_224.npz',
+                        test_images=rng.integers(0, 256, (6, 224, 224), dtype=np.uint8),
+                        test_labels=rng.integers(0, 2, (6, 1), dtype=np.uint8))
+
+    # A cheap corruption is enough
+    monkeypatch.setitem(registry.CORRUPTIONS_DS, DATASET, {'pixelate': registry.CORRUPTIONS_DS[DATASET]['pixelate']})
+    return str(path)
+
+
+@pytest.mark.parametrize('formats', [('npy', 'npz'), ('npz', 'npy')])
+def test_switch_storage_format(clean_path, tmp_path, formats):
+    output_path = str(tmp_path / 'corrupted')
+
+    for storage_format in formats:
+        # Streaming mode: the clean split is read from the npz file, without MedMNIST's dataset class
+        manager = DatasetManager(clean_path, output_path, chunk_size=4, memory_budget=2 * 1024 ** 3, storage_format=storage_format)
+        manager.create_dataset(DATASET)
+
+    old_format, new_format = formats
+    assert (tmp_path / 'corrupted' / DATASET / f'pixelate.{new_format}').exists()
+    assert not (tmp_path / 'corrupted' / DATASET / f'pixelate.{old_format}').exists()
+    assert manager.load_manifest()[f'{DATASET}/pixelate']['file'] == f'{DATASET}/pixelate.{new_format}'
+
+    images, labels = load_corrupted_test_set(output_path, DATASET, 'pixelate')
+    assert images.shape == (30, 224, 224) and labels.shape == (30, 1)
+
+
+def test_manifest_versions(clean_path, tmp_path):
+    manager = DatasetManager(clean_path, str(tmp_path / 'corrupted'), chunk_size=4, memory_budget=2 * 1024 ** 3)
+    manager.create_dataset(DATASET)
+
+    # Only the libraries used by the corruption: e.g. upgrading PyTorch does not make the outputs stale
+    versions = manager.load_manifest()[f'{DATASET}/pixelate']['versions']
+    assert sorted(versions) == ['PIL', 'medmnistc', 'numpy']
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import cv2
+
+from medmnistc.corruptions import filter
+from medmnistc.corruptions.filter import MotionBlur
+
+
+SEVERITY_PARAMS = [(3, 3), (5, 5), (10, 5), (15, 8), (20, 15)]
+
+requires_wand = pytest.mark.skipif(filter.WandImage is None, reason="Wand and ImageMagick are not installed")
+
+
+def _images(num_images=4, size=64, seed=0):
+    rng = np.random.default_rng(seed)
+    imgs = rng.integers(0, 256, (num_images, size, size, 3), dtype=np.uint8)
+    # Gray image and sharp edges
+    imgs[0] = imgs[0, ..., :1]
+    imgs[1, :, :size // 2] = 255
+    imgs[1, :, size // 2:] = 0
+    return imgs
+
+
+def test_default_engine():
+    expected = 'native' if filter.WandImage is None else 'wand'
+    assert MotionBlur(SEVERITY_PARAMS).engine == expected
+    assert MotionBlur(SEVERITY_PARAMS).get_config()['engine'] == expected
+
+
+@requires_wand
+@pytest.mark.parametrize('severity', range(len(SEVERITY_PARAMS)))
+def test_native_matches_wand(severity):
+    native = MotionBlur(SEVERITY_PARAMS, engine='native')
+    wand = MotionBlur(SEVERITY_PARAMS, engine='wand')
+
+    for index, img in enumerate(_images()):
+        # Same random angle for both engines
+        expected = wand.apply(img, severity, rng=np.random.default_rng(index)).astype(np.int16)
+        out = native.apply(img, severity, rng=np.random.default_rng(index))
+        assert out.dtype == np.uint8 and out.shape == img.shape
+        assert np.abs(out.astype(np.int16) - expected).max() <= 1
+
+
+@requires_wand
+@pytest.mark.parametrize('angle', [-45, -30, 0, 15, 45])
+def test_native_matches_wand_angles(angle):
+    img = _images()[2]
+
+    with filter.MotionImage(blob=cv2.imencode('.png', img)[1].tobytes()) as wand_img:
+        wand_img.motion_blur(radius=10, sigma=5, angle=angle)
+        expected = cv2.imdecode(np.frombuffer(wand_img.make_blob(), np.uint8), cv2.IMREAD_UNCHANGED)
+
+    out = filter.motion_blur(img, 10, 5, angle)
+    assert np.abs(out.astype(np.int16) - expected.astype(np.int16)).max() <= 1
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from medmnistc.corruptions.enhance import Saturate
+
+
+SEVERITY_PARAMS = [0.05, 0.10, 0.15, 0.20, 0.25]
+
+
+def _images(num_images=8, size=64, seed=0):
+    rng = np.random.default_rng(seed)
+    imgs = rng.integers(0, 256, (num_images, size, size, 3), dtype=np.uint8)
+    # Gray images (null saturation) and saturated extremes
+    imgs[0] = imgs[0, ..., :1]
+    imgs[1, :size // 2] = [255, 0, 0]
+    imgs[1, size // 2:] = [0, 0, 0]
+    return imgs
+
+
+@pytest.mark.parametrize('severity', range(len(SEVERITY_PARAMS)))
+def test_opencv_matches_skimage(severity):
+    imgs = _images()
+    opencv = Saturate(SEVERITY_PARAMS, engine='opencv')
+    skimage = Saturate(SEVERITY_PARAMS, engine='skimage')
+
+    for img in imgs:
+        expected = skimage.apply(img, severity).astype(np.int16)
+        out = opencv.apply(img, severity)
+        assert out.dtype == np.uint8 and out.shape == img.shape
+        assert np.abs(out.astype(np.int16) - expected).max() <= 1
+
+
+def test_opencv_matches_skimage_augmentation():
+    imgs = _images()
+    opencv = Saturate(SEVERITY_PARAMS, engine='opencv')
+    skimage = Saturate(SEVERITY_PARAMS, engine='skimage')
+
+    for index, img in enumerate(imgs):
+        expected = skimage.apply(img, augmentation=True, rng=np.random.default_rng(index)).astype(np.int16)
+        out = opencv.apply(img, augmentation=True, rng=np.random.default_rng(index))
+        assert np.abs(out.astype(np.int16) - expected).max() <= 1
+
+
+@pytest.mark.parametrize('engine', ['opencv', 'skimage'])
+@pytest.mark.parametrize('augmentation', [False, True])
+def test_apply_batch_matches_apply(engine, augmentation):
+    imgs = _images()
+    corruption = Saturate(SEVERITY_PARAMS, engine=engine)
+
+    out = corruption.apply_batch(imgs, severity=2, augmentation=augmentation,
+                                 rng=[np.random.default_rng(index) for index in range(len(imgs))])
+    expected = np.stack([corruption.apply(img, severity=2, augmentation=augmentation, rng=np.random.default_rng(index))
+                         for index, img in enumerate(imgs)])
+    np.testing.assert_array_equal(out, expected)
@@ -0,0 +1,48 @@
+import os
+import time
+
+import pytest
+
+from medmnistc.utils import storage
+
+
+@pytest.fixture(params=['fcntl', 'fallback'])
+def lock_backend(request, monkeypatch):
+    if request.param == 'fcntl' and storage.fcntl is None:
+        pytest.skip('fcntl is not available')
+    if request.param == 'fallback':
+        monkeypatch.setattr(storage, 'fcntl', None)
+        monkeypatch.setattr(storage, 'msvcrt', None)
+    return request.param
+
+
+def test_file_lock_timeout(tmp_path, lock_backend):
+    lock_path = str(tmp_path / 'cache.lock')
+    with storage.file_lock(lock_path):
+        with pytest.raises(TimeoutError):
+            with storage.file_lock(lock_path, poll_interval=0.01, timeout=0.1):
+                pass
+
+    # Released
+    with storage.file_lock(lock_path, timeout=0.1):
+        pass
+
+
+def test_file_lock_breaks_stale_lock(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'fcntl', None)
+    monkeypatch.setattr(storage, 'msvcrt', None)
+    lock_path = str(tmp_path / 'cache.lock')
+
+    # Lock file left by a killed process
+    with open(lock_path, 'w') as f:
+        f.write('12345')
+    with pytest.raises(TimeoutError):
+        with storage.file_lock(lock_path, poll_interval=0.01, timeout=0.1, stale_after=60):
+            pass
+
+    old = time.time() - 120
+    os.utime(lock_path, (old, old))
+    with storage.file_lock(lock_path, poll_interval=0.01, timeout=0.1, stale_after=60):
+        with open(lock_path) as f:
+            assert f.read() == str(os.getpid())
+    assert not os.path.exists(lock_path)
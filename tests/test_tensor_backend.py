@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import cv2
+
+torch = pytest.importorskip('torch')
+
+from medmnistc.corruptions.registry import CORRUPTIONS_DS
+from medmnistc.corruptions.base import image_rng, to_grayscale
+
+
+# One instance of each corruption name (the first dataset defining it)
+CORRUPTIONS = {}
+for corruptions in CORRUPTIONS_DS.values():
+    for name, corruption in corruptions.items():
+        CORRUPTIONS.setdefault(name, corruption)
+
+# Float32 filtering, whose roundings may differ from OpenCV's by 1 gray level
+BLURS = ['gaussian_blur', 'defocus_blur']
+
+# Noise drawn from torch's generators: only its statistics are comparable
+NOISES = ['gaussian_noise', 'speckle_noise', 'impulse_noise', 'shot_noise']
+
+
+def _images(num_images=4, seed=0):
+    # Smooth RGB images of the 224 datasets
+    base = np.random.default_rng(seed).integers(0, 256, (num_images, 28, 28, 3), dtype=np.uint8)
+    return np.stack([cv2.resize(img, (224, 224), interpolation=cv2.INTER_CUBIC) for img in base])
+
+
+def _rngs(num_images):
+    return [image_rng(7, index) for index in range(num_images)]
+
+
+@pytest.mark.parametrize('channels', [1, 3])
+@pytest.mark.parametrize('augmentation', [False, True])
+@pytest.mark.parametrize('name', sorted(CORRUPTIONS))
+def test_apply_tensor_matches_apply_batch(name, augmentation, channels):
+    corruption = CORRUPTIONS[name]
+    imgs = _images()
+    if channels == 1:
+        imgs = imgs[..., :1]
+    tensor = torch.from_numpy(np.ascontiguousarray(imgs.transpose(0, 3, 1, 2)))
+
+    out = corruption.apply_tensor(tensor, 2, augmentation, rng=_rngs(len(imgs)))
+    assert out.dtype == torch.uint8 and tuple(out.shape) == tuple(tensor.shape)
+    out = out.permute(0, 2, 3, 1).numpy().astype(np.int16)
+
+    # Reference: RGB batch, converted back to greyscale as `DatasetManager` does
+    rgb = np.ascontiguousarray(tensor.expand(-1, 3, -1, -1).permute(0, 2, 3, 1).numpy())
+    expected = corruption.apply_batch(rgb, 2, augmentation, rng=_rngs(len(imgs)))
+    if channels == 1:
+        expected = to_grayscale(expected)[..., None]
+    expected = expected.astype(np.int16)
+
+    if name in NOISES:
+        assert abs(out.mean() - expected.mean()) < 1
+        assert abs(out.std() - expected.std()) < 1
+    elif name in BLURS:
+        assert np.abs(out - expected).max() <= 1
+    else:
+        np.testing.assert_array_equal(out, expected)